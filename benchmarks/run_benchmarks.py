@@ -0,0 +1,337 @@
+'''
+Benchmarks for the SpatiaLite I/O and LAS decimation hot paths.
+
+Each benchmark is run over a range of sizes (a scaling curve), on synthetic data from synthetic.py, and reports the
+wall time (best of --repeat runs), the throughput in rows (or samples) per second and the peak python memory (tracemalloc,
+which includes NumPy buffers). The peak memory is measured in a separate, untimed, run, as tracemalloc slows the code
+it traces down many times over. The results are saved as json in benchmarks/results, labelled with the git commit by default,
+and can be compared against an earlier results file to catch regressions between versions:
+
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --only decimation las_io --scale 0.1
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/<earlier label>.json --threshold 1.25
+
+Benchmarks that need the mod_spatialite extension are skipped when it can't be loaded.
+'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from synthetic import make_dataframe, make_geodataframe, make_las_file
+from generic_utils import db_utils, decimation, las_io, pandas_spatialite
+from generic_utils.LASdecimator import decimate_file
+
+RESULTS_DIR = os.path.join(HERE, 'results')
+
+# name: (sizes, needs spatialite, setup(n, workdir) -> state, run(state) -> rows processed)
+BENCHMARKS = {}
+
+
+def benchmark(name, sizes, spatialite = False, setup = None):
+    '''
+    Register a benchmark. The decorated function is the timed part, and is passed whatever setup() returned
+    (or (n, workdir) if there is no setup), and returns the number of rows or samples it processed.
+    '''
+    def register(run):
+        BENCHMARKS[name] = (sizes, spatialite, setup, run)
+        return run
+    return register
+
+
+def have_spatialite():
+    '''
+    Whether the mod_spatialite extension can be loaded here
+    '''
+    try:
+        db_utils.loadSpatialite(sqlite3.connect(':memory:')).close()
+        return True
+    except Exception:
+        return False
+
+
+def spatialite_con(path):
+    con = db_utils.loadSpatialite(sqlite3.connect(path))
+    con.cursor().execute('SELECT InitSpatialMetaData(1);')
+    return con
+
+
+@contextlib.contextmanager
+def quiet():
+    '''
+    Hide the progress printing of the functions being timed
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+# ------------------------------------------------------------------------------------------------
+# SpatiaLite I/O
+
+def _write_setup(frame_maker, spatial):
+    def setup(n, workdir):
+        df = frame_maker(n)
+        path = os.path.join(workdir, 'bench.sqlite')
+        if os.path.exists(path):
+            os.remove(path)
+        con = spatialite_con(path) if spatial else sqlite3.connect(path)
+        return df, con
+    return setup
+
+
+def _read_setup(frame_maker, spatial):
+    def setup(n, workdir):
+        df, con = _write_setup(frame_maker, spatial)(n, workdir)
+        with quiet():
+            pandas_spatialite.gpd_to_spatialite(df, con, 'bench')
+        return con
+    return setup
+
+
+@benchmark('gpd_to_spatialite.dataframe', [10000, 100000, 1000000], setup = _write_setup(make_dataframe, False))
+def bench_write_dataframe(state):
+    df, con = state
+    with quiet():
+        pandas_spatialite.gpd_to_spatialite(df, con, 'bench')
+    con.close()
+    return len(df)
+
+
+@benchmark('gpd_to_spatialite.polygons', [1000, 10000, 100000], spatialite = True,
+           setup = _write_setup(lambda n: make_geodataframe(n, vertices = 64), True))
+def bench_write_polygons(state):
+    df, con = state
+    with quiet():
+        pandas_spatialite.gpd_to_spatialite(df, con, 'bench')
+    con.close()
+    return len(df)
+
+
+@benchmark('spatialite_to_gdb.dataframe', [10000, 100000, 1000000], setup = _read_setup(make_dataframe, False))
+def bench_read_dataframe(con):
+    return len(pandas_spatialite.spatialite_to_gdb(con, 'bench'))
+
+
+@benchmark('spatialite_to_gdb.polygons', [1000, 10000, 100000], spatialite = True,
+           setup = _read_setup(lambda n: make_geodataframe(n, vertices = 64), True))
+def bench_read_polygons(con):
+    return len(pandas_spatialite.spatialite_to_gdb(con, 'bench'))
+
+
+def _makecon_setup(n, workdir):
+    con = _read_setup(make_dataframe, True)(n, workdir)
+    con.close()
+    db_path = os.path.join(workdir, 'bench.sqlite')
+    cache_dir = os.path.join(workdir, 'cache')
+    shutil.rmtree(cache_dir, ignore_errors = True)
+    os.makedirs(cache_dir)
+    with quiet():
+        # Make the working copy once, so the timed part is reconnecting to an unchanged database
+        db_utils.closeCon(db_utils.makeCon(db_path, cache_dir = cache_dir), db_path, cache_dir = cache_dir)
+    return n, db_path, cache_dir
+
+
+@benchmark('makeCon.unchanged', [10000, 1000000], spatialite = True, setup = _makecon_setup)
+def bench_makecon_unchanged(state):
+    n, db_path, cache_dir = state
+    with quiet():
+        db_utils.closeCon(db_utils.makeCon(db_path, cache_dir = cache_dir), db_path, cache_dir = cache_dir)
+    return n
+
+
+@benchmark('makeCon.refresh', [10000, 1000000], spatialite = True, setup = _makecon_setup)
+def bench_makecon_refresh(state):
+    n, db_path, cache_dir = state
+    with quiet():
+        db_utils.closeCon(db_utils.makeCon(db_path, cache_dir = cache_dir), db_path, remove_copy = True, cache_dir = cache_dir)
+    return n
+
+
+# ------------------------------------------------------------------------------------------------
+# LAS decimation
+
+def _curves_setup(n, workdir):
+    rng = np.random.default_rng(0)
+    return np.arange(n) * 0.1, np.cumsum(rng.normal(0, 1, (n, 8)), axis = 0)
+
+
+def _decimation_benchmark(method):
+    def run(state):
+        depth, data = state
+        if method == 'resample':
+            decimation.decimate(depth, data, method = method, interval = 0.25)
+        else:
+            decimation.decimate(depth, data, 0.9, method)
+        return len(depth)
+    return run
+
+
+for _method in decimation.METHODS:
+    benchmark('decimation.' + _method, [100000, 1000000, 4000000], setup = _curves_setup)(_decimation_benchmark(_method))
+
+
+def _las_setup(n, workdir):
+    path = make_las_file(os.path.join(workdir, 'bench.las'), n)
+    return n, path, workdir
+
+
+@benchmark('las_io.read_las', [10000, 100000, 1000000], setup = _las_setup)
+def bench_read_las(state):
+    n, path, workdir = state
+    las, data = las_io.read_las(path)
+    return len(data)
+
+
+@benchmark('las_io.write_las', [10000, 100000, 1000000],
+           setup = lambda n, workdir: _las_setup(n, workdir) + (las_io.read_las(os.path.join(workdir, 'bench.las'))[1],))
+def bench_write_las(state):
+    n, path, workdir, data = state
+    las_io.write_las(os.path.join(workdir, 'out.las'), path, data)
+    return len(data)
+
+
+@benchmark('LASdecimator.decimate_file', [10000, 100000, 1000000], setup = _las_setup)
+def bench_decimate_file(state):
+    n, path, workdir = state
+    decimate_file(path, workdir, 0.9)
+    return n
+
+
+# ------------------------------------------------------------------------------------------------
+
+def measure(setup, run, n, workdir, repeat):
+    '''
+    Time run() (after a fresh setup() each time), keeping the best time of repeat runs, then record its peak memory
+    in one more run under tracemalloc, which isn't timed
+    '''
+    best = None
+    for _ in range(repeat):
+        state = setup(n, workdir) if setup is not None else (n, workdir)
+        start = time.perf_counter()
+        rows = run(state)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    state = setup(n, workdir) if setup is not None else (n, workdir)
+    tracemalloc.start()
+    try:
+        run(state)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'n': n, 'rows': rows, 'seconds': best, 'rows_per_sec': rows / best if best > 0 else None,
+            'peak_mb': peak / 2 ** 20}
+
+
+def run_benchmarks(names = None, scale = 1.0, repeat = 3):
+    '''
+    Run the benchmarks whose names start with any of names (or all of them)
+
+    :return:
+    A list of result dicts
+    '''
+    spatialite = have_spatialite()
+    results = []
+    for name, (sizes, needs_spatialite, setup, run) in BENCHMARKS.items():
+        if names and not any(name.startswith(prefix) for prefix in names):
+            continue
+        if needs_spatialite and not spatialite:
+            print('{:<32} skipped, mod_spatialite is not available'.format(name))
+            continue
+        workdir = tempfile.mkdtemp(prefix = 'bench_')
+        try:
+            for size in sizes:
+                n = max(1, int(size * scale))
+                try:
+                    result = measure(setup, run, n, workdir, repeat)
+                except Exception as e:
+                    print('{:<32} n={:<10,} failed: {}: {}'.format(name, n, type(e).__name__, e))
+                    results.append({'name': name, 'n': n, 'error': '{}: {}'.format(type(e).__name__, e)})
+                    break
+                result['name'] = name
+                results.append(result)
+                print('{:<32} n={:<10,} {:>9.4f} s {:>14,.0f} rows/s {:>9.1f} MB peak'.format(
+                    name, n, result['seconds'], result['rows_per_sec'] or 0, result['peak_mb']))
+        finally:
+            shutil.rmtree(workdir, ignore_errors = True)
+    return results
+
+
+def default_label():
+    '''
+    The short hash of the current git commit, or a timestamp if this isn't a git checkout
+    '''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = HERE,
+                                       stderr = subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return datetime.now().strftime('%Y%m%d-%H%M%S')
+
+
+def compare(results, baseline_path, threshold):
+    '''
+    Compare results against an earlier results file, printing the time ratio for each benchmark and size.
+
+    :return:
+    The number of regressions, ie where the time has grown by more than threshold times
+    '''
+    with open(baseline_path) as f:
+        baseline = {(r['name'], r['n']): r for r in json.load(f)['results'] if 'seconds' in r}
+    regressions = 0
+    print('\nCompared with {}:'.format(baseline_path))
+    for result in results:
+        old = baseline.get((result['name'], result['n']))
+        if old is None or 'seconds' not in result:
+            continue
+        ratio = result['seconds'] / old['seconds'] if old['seconds'] > 0 else float('inf')
+        flag = ''
+        if ratio > threshold:
+            flag = '  <-- REGRESSION'
+            regressions += 1
+        print('{:<32} n={:<10,} {:>6.2f}x time {:>6.2f}x memory{}'.format(
+            result['name'], result['n'], ratio, result['peak_mb'] / old['peak_mb'] if old['peak_mb'] else 0, flag))
+    return regressions
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark the SpatiaLite I/O and LAS decimation hot paths.')
+    parser.add_argument('--only', nargs = '*', default = None, help = 'only run the benchmarks starting with these names')
+    parser.add_argument('--scale', type = float, default = 1.0, help = 'multiply all the benchmark sizes by this (default 1)')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'runs per size, the best time is kept (default 3)')
+    parser.add_argument('--label', default = None, help = 'name of the results file (default: the git commit)')
+    parser.add_argument('--compare', default = None, help = 'earlier results file to compare against')
+    parser.add_argument('--threshold', type = float, default = 1.2,
+                        help = 'time ratio above which a result counts as a regression (default 1.2)')
+    parser.add_argument('--no-save', action = 'store_true', help = "don't save the results")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.only, args.scale, args.repeat)
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok = True)
+        label = args.label or default_label()
+        path = os.path.join(RESULTS_DIR, label + '.json')
+        with open(path, 'w') as f:
+            json.dump({'label': label, 'timestamp': datetime.now().isoformat(), 'python': platform.python_version(),
+                       'platform': platform.platform(), 'scale': args.scale, 'results': results}, f, indent = 1)
+        print('\nResults saved to {}'.format(path))
+    if args.compare is not None:
+        return 1 if compare(results, args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
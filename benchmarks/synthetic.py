@@ -0,0 +1,111 @@
+'''
+Synthetic data generators for the benchmarks: DataFrames and GeoDataFrames of any size and geometry complexity,
+and .LAS files of any depth and number of curves. Everything is seeded, so every run sees the same data.
+'''
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+
+def make_dataframe(nrows, ncols = 8, seed = 0):
+    '''
+    A DataFrame with a mix of the column types found in the borehole and survey tables:
+    integers, floats (with some missing values), short strings (with some missing values) and datetimes.
+
+    :param: nrows, the number of rows
+    :param: ncols, the number of columns, cycling through the column types
+    :param: seed, the random seed
+    '''
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for i in range(ncols):
+        kind = i % 4
+        if kind == 0:
+            columns['int_{}'.format(i)] = rng.integers(0, 1000000, nrows)
+        elif kind == 1:
+            values = rng.normal(100, 25, nrows)
+            values[rng.random(nrows) < 0.05] = np.nan
+            columns['float_{}'.format(i)] = values
+        elif kind == 2:
+            values = np.asarray(['site_{}'.format(v) for v in rng.integers(0, 5000, nrows)], dtype = object)
+            values[rng.random(nrows) < 0.05] = None
+            columns['text_{}'.format(i)] = values
+        else:
+            columns['date_{}'.format(i)] = pd.Timestamp('2000-01-01') + pd.to_timedelta(rng.integers(0, 7000, nrows), unit = 'D')
+    return pd.DataFrame(columns)
+
+
+def make_geodataframe(nrows, vertices = 32, geom_type = 'polygon', ncols = 4, epsg = 4326, seed = 0):
+    '''
+    A GeoDataFrame of random points, or irregular polygons with a given number of vertices, spread over Australia.
+
+    :param: nrows, the number of rows
+    :param: vertices, the number of vertices per polygon, ie the geometry complexity
+    :param: geom_type, 'point' or 'polygon'
+    :param: ncols, the number of attribute columns, see make_dataframe()
+    :param: epsg, the EPSG code of the CRS
+    :param: seed, the random seed
+    '''
+    rng = np.random.default_rng(seed)
+    df = make_dataframe(nrows, ncols, seed)
+    x = rng.uniform(113, 153, nrows)
+    y = rng.uniform(-43, -11, nrows)
+    if geom_type == 'point':
+        geoms = shapely.points(x, y)
+    elif geom_type == 'polygon':
+        # Star shaped rings of noisy radius around each centre, closed by repeating the first vertex
+        angles = np.linspace(0, 2 * np.pi, vertices, endpoint = False)
+        radius = rng.uniform(0.005, 0.05, (nrows, 1)) * rng.uniform(0.6, 1.0, (nrows, vertices))
+        xs = x[:, np.newaxis] + radius * np.cos(angles)
+        ys = y[:, np.newaxis] + radius * np.sin(angles)
+        coords = np.stack([xs, ys], axis = -1)
+        coords = np.concatenate([coords, coords[:, :1]], axis = 1)
+        geoms = shapely.polygons(coords)
+    else:
+        raise Exception('geom_type must be "point" or "polygon", not "{}"'.format(geom_type))
+    return gpd.GeoDataFrame(df, geometry = geoms, crs = 'epsg:{}'.format(epsg))
+
+
+def make_las_file(path, nsamples, ncurves = 8, step = 0.1, null_value = -999.25, seed = 0):
+    '''
+    Write a synthetic LAS 2.0 file: a depth index at a regular step and ncurves noisy curves, with a few null values.
+
+    :param: path, the path to write to
+    :param: nsamples, the number of depth samples
+    :param: ncurves, the number of log curves (besides depth)
+    :param: step, the depth step
+    :param: null_value, the NULL value to use for the missing samples
+    :param: seed, the random seed
+
+    :return:
+    The path written to
+    '''
+    rng = np.random.default_rng(seed)
+    depth = np.arange(nsamples) * step
+    curves = np.cumsum(rng.normal(0, 1, (nsamples, ncurves)), axis = 0) + 100
+    curves[rng.random((nsamples, ncurves)) < 0.01] = null_value
+    data = np.column_stack([depth, curves])
+    names = ['C{:02d}'.format(i) for i in range(ncurves)]
+    header = ['~Version Information',
+              ' VERS.   2.0 : CWLS LOG ASCII STANDARD - VERSION 2.0',
+              ' WRAP.    NO : ONE LINE PER DEPTH STEP',
+              '~Well Information',
+              ' STRT.M  {:.4f} : START DEPTH'.format(depth[0] if nsamples else 0),
+              ' STOP.M  {:.4f} : STOP DEPTH'.format(depth[-1] if nsamples else 0),
+              ' STEP.M  {:.4f} : STEP'.format(step),
+              ' NULL.   {} : NULL VALUE'.format(null_value),
+              ' WELL.   SYNTHETIC_{} : WELL'.format(seed),
+              ' UWI .   SYN{:06d} : UNIQUE WELL ID'.format(seed),
+              ' LATI.   {:.5f} : LATITUDE'.format(rng.uniform(-43, -11)),
+              ' LONG.   {:.5f} : LONGITUDE'.format(rng.uniform(113, 153)),
+              '~Curve Information',
+              ' DEPT.M : DEPTH'] + [' {}.API : SYNTHETIC CURVE {}'.format(name, i) for i, name in enumerate(names)] + [
+              '~ASCII']
+    row_fmt = ' '.join(['%.4f'] * data.shape[1]) + '\n'
+    with open(path, 'w') as f:
+        f.write('\n'.join(header) + '\n')
+        for start in range(0, nsamples, 20000):
+            block = data[start:start + 20000]
+            f.write((row_fmt * len(block)) % tuple(block.ravel().tolist()))
+    return path
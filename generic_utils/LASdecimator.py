@@ -12,70 +12,299 @@
 #                                                        #
 ##########################################################
 
+# This can be used as a library:
+#
+#   from generic_utils.LASdecimator import decimate_directory
+#   decimate_directory(las_dir, out_dir, decimation_factor = 0.9, workers = 8)
+#
+# or from the command line:
+#
+#   python -m generic_utils.LASdecimator las_dir out_dir --factor 0.9 --workers 8
+#
+# Add --incremental (incremental = True) to only redo the files that are new or have changed since the last run.
+#
+# las_dir is searched recursively, so it can either be the directory holding all the .LAS files,
+# or the deepest directory that contains all of them (eg "project\bores" for project\bores\hole_name\hole.LAS)
+# The sub directories are mirrored in out_dir (eg out_dir\hole_name\holedecimated0.9.LAS)
+# The decimation factor must be > 0 and < 1.
+# For example, 0.5 will remove every second sample. 0.9 will remove 9/10 samples.
+# Instead of keeping every Nth sample, the samples can also be block averaged (--method mean), reduced to the
+# block minimum and maximum (--method minmax) or resampled to a fixed depth interval (--method resample --interval 0.5)
+
 
 # Import required packages
+import argparse
+import json
 import os
-import pandas as pd
-import lasio
-
-######################################
-
-# USER CONFIGURATION AREA
-#-------------------------------------
-
-# This script supports two possible use cases:
-# Case 1:  All .LAS files are already in one directory,
-# Case 2: The las files are in subdirectories (eg project\bores\hole_name\hole.LAS
-
-# For Case 1, enter the path to the directory as the value for the las_dir variable
-# For Case 2, point to the deepest directory that contains all the .LAS files,
-# which would be "project\bores" in the example path
-# Enter working directory here
-las_dir = r 'enter/path/here'
-
-# Case 1: Uncomment this line if all your data is in a single directory. Comment out the subsequent block of code.
-# List comprehension to create a list of all files in the directory ending with .las (case insensitive)
-las_files = [las_dir + '\\' + file for file in os.listdir(las_dir) if file.lower()[-4::] == '.las']
-
-# Case 2: Uncomment these lines if all your data is in nested directories
-las_files = []
-# Loop through all directories and sub directories with os.walk, unpacking the resulting tuple
-for dir, sub_dir, files in os.walk(las_dir):
-	# Loop through each file in each directory
-	for file in files:
-		if file.lower()[-4::] == '.las':
-			# If the file is a .las (case insensitive), add it to a list
-			las_files.append(dir + '\\' + file)
-
-# Enter the output directory, where you'd like your decimated .LAS files saved:
-out_dir = r'enter\path\here'
-
-# Select your decimation factor. Must be > 0 and <= 1.
-# For example, 0.5 will remove every second sample. 0.9 will remove 9/10 samples.
-decimation_factor = 0.9
-
-### END USER CONFIGURATION AREA
-####################################
-
-# Loop through each file
-for las_file in las_files:
-	# Split the entire path up just to harvest file name
-	file_name = las.split('\\')[-1]
-	# Add in a suffix to the file name stating that the output has been decimated and at what factor
-	new_file_name = file_name.replace('.', 'decimated' + str(decimation_factor) + '.')
-	
-	# Read the las file into memory
-	las = lasio.read(las_file)
-	# pull the data into a pandas dataframe
-	df = las.df()
-	# conver the decimation factor to a denominator for a modulo (remainder) division
-	modulo = 1 / (1 - decimation_factor)
-	# List comprehension to build a list of the row names (depths) for each of the rows in which the
-	# row number divided by modulo yields no remainder. Eg 10%5 = 0, 12%5 = 2.
-	rows_to_keep = [row for i, row in enumerate(df.index) if i % modulo == 0]
-	# Assign just the subset of rows back to the dataframe (ie remove the unwanted rows)
-	df = df.loc[rows_to_keep]
-	# Set the now decimated data as the values for the las object
-	las.set_data(df)
-	# Save the modified las data, with the original header to the requested output directory
-	las.write(out_dir + '\\' + new_file_name)
\ No newline at end of file
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+
+try:
+	from .db_utils import fileSignature
+	from .decimation import METHODS, decimate
+	from .las_io import read_las, write_las
+except ImportError:
+	# Run directly as a script, rather than as part of the package, so make the package importable
+	sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+	from generic_utils.db_utils import fileSignature
+	from generic_utils.decimation import METHODS, decimate
+	from generic_utils.las_io import read_las, write_las
+
+
+def find_las_files(las_dir, recursive = True):
+	'''
+	Find all the .las files (case insensitive) in a directory, and optionally all of its sub directories.
+
+	:param: las_dir, the directory to search
+	:param: recursive, also search all the sub directories
+
+	:return:
+	A sorted list of the paths to the .las files
+	'''
+	if not recursive:
+		return sorted(os.path.join(las_dir, file) for file in os.listdir(las_dir) if file.lower().endswith('.las'))
+	las_files = []
+	# Loop through all directories and sub directories with os.walk, unpacking the resulting tuple
+	for dir, sub_dir, files in os.walk(las_dir):
+		# Loop through each file in each directory
+		for file in files:
+			if file.lower().endswith('.las'):
+				# If the file is a .las (case insensitive), add it to a list
+				las_files.append(os.path.join(dir, file))
+	return sorted(las_files)
+
+
+def decimated_file_name(las_file, decimation_factor, method = 'stride', interval = None):
+	'''
+	The output file name, with a suffix stating that the output has been decimated and at what factor
+	(or resampled, and at what interval)
+	'''
+	root, ext = os.path.splitext(os.path.basename(las_file))
+	if method == 'resample':
+		return root + 'resampled' + str(interval) + ext
+	suffix = 'decimated' + str(decimation_factor)
+	if method != 'stride':
+		suffix += method
+	return root + suffix + ext
+
+
+def decimate_file(las_file, out_dir, decimation_factor, method = 'stride', interval = None):
+	'''
+	Read a single .las file, decimate its depth samples and write it to out_dir, with the original header.
+	The curves are decimated as whole arrays, see decimation.decimate() for the methods, and the file is read and
+	written with the fast las_io functions, so the data is only ever held as one numpy array.
+
+	:param: las_file, the path to the .las file
+	:param: out_dir, the directory to write the decimated file to
+	:param: decimation_factor, the share of the samples to remove, > 0 and < 1
+	:param: method, the decimation method, one of decimation.METHODS
+	:param: interval, the depth interval for the 'resample' method
+
+	:return:
+	A tuple of (output path, number of samples read, number of samples written)
+	'''
+	# Read the las file: lasio parses the header, and the data section goes straight into a numpy array
+	las, data = read_las(las_file)
+	# The first curve is the depth index, the rest are the log curves
+	new_depth, new_data = decimate(data[:, 0], data[:, 1:], decimation_factor, method, interval)
+	# Save the decimated data, with the original header to the requested output directory
+	os.makedirs(out_dir, exist_ok = True)
+	out_path = os.path.join(out_dir, decimated_file_name(las_file, decimation_factor, method, interval))
+	write_las(out_path, las_file, np.column_stack([new_depth, new_data]))
+	return out_path, len(data), len(new_depth)
+
+
+def output_dirs(las_files, out_dir, las_dir = None):
+	'''
+	The directory to write each decimated file to. With las_dir, the sub directories of each file under las_dir are
+	mirrored under out_dir, so files with the same name in different directories don't overwrite each other.
+	Without it everything goes straight into out_dir, and two files that would write the same output are an error.
+
+	:param: las_files, the paths of the .las files
+	:param: out_dir, the directory the decimated files go in
+	:param: las_dir, optional directory that all of las_files are under
+
+	:return:
+	A list of the output directory of each file
+	'''
+	if las_dir is None:
+		dirs = [out_dir] * len(las_files)
+	else:
+		dirs = [os.path.normpath(os.path.join(out_dir, os.path.relpath(os.path.dirname(las_file), las_dir)))
+				for las_file in las_files]
+	# Compared case insensitively, as the output may be on a case insensitive file system
+	seen = {}
+	for las_file, dir in zip(las_files, dirs):
+		key = os.path.normcase(os.path.join(dir, os.path.basename(las_file))).lower()
+		if key in seen:
+			raise Exception('{} and {} would both be decimated to the same file in {}'.format(seen[key], las_file, dir))
+		seen[key] = las_file
+	return dirs
+
+
+def _decimate_file_safely(las_file, out_dir, decimation_factor, method = 'stride', interval = None):
+	'''
+	Runs decimate_file() in a worker process, catching any error so one bad file can't stop the batch.
+
+	:return:
+	A tuple of (las_file, result of decimate_file or None, error message or None)
+	'''
+	try:
+		return las_file, decimate_file(las_file, out_dir, decimation_factor, method, interval), None
+	except Exception as e:
+		return las_file, None, '{}: {}'.format(type(e).__name__, e)
+
+
+# The manifest of already decimated files kept in out_dir by the incremental mode
+MANIFEST_NAME = '.las_manifest.json'
+
+
+def load_manifest(out_dir):
+	'''
+	Load the manifest of decimated files from out_dir, as a dict of source path: entry, or an empty dict if there isn't one
+	'''
+	manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+	if not os.path.exists(manifest_path):
+		return {}
+	with open(manifest_path) as f:
+		return json.load(f)
+
+
+def save_manifest(out_dir, manifest):
+	'''
+	Save the manifest of decimated files to out_dir, swapping the new file in so it is never left half written
+	'''
+	manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+	with open(manifest_path + '.tmp', 'w') as f:
+		json.dump(manifest, f, indent = 1, sort_keys = True)
+	os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def decimate_files(las_files, out_dir, decimation_factor, workers = None, method = 'stride', interval = None,
+				   incremental = False, verify = 'mtime', las_dir = None):
+	'''
+	Decimate many .las files, on a pool of worker processes.
+	Each file is read, decimated and written independently, and a failure in one file is recorded and reported
+	without affecting the others.
+
+	:param: las_files, the paths of the .las files to decimate
+	:param: out_dir, the directory to write the decimated files to. Created if it doesn't exist
+	:param: decimation_factor, the share of the samples to remove, > 0 and < 1
+	:param: workers, the number of worker processes. Defaults to the number of CPUs; 1 runs everything in this process
+	:param: method, the decimation method, one of decimation.METHODS
+	:param: interval, the depth interval for the 'resample' method
+	:param: incremental, skip files that were already decimated with the same parameters and haven't changed since.
+			A manifest of the source signatures, parameters and outputs is kept in out_dir to keep track
+	:param: verify, how to tell if a source file has changed in incremental mode, see db_utils.fileSignature()
+	:param: las_dir, optional directory all of las_files are under, whose sub directories are mirrored in out_dir.
+			Without it all the outputs go straight into out_dir, and files that would have the same output name are an error
+
+	:return:
+	A summary dict with the processed, skipped and failed files (and their errors) and throughput figures
+	'''
+	if method not in METHODS:
+		raise Exception('method must be one of {}, not "{}"'.format(METHODS, method))
+	if method == 'resample' and interval is None:
+		raise Exception('An interval must be given for the resample method')
+	if method != 'resample' and not 0 < decimation_factor < 1:
+		raise Exception('The decimation factor must be > 0 and < 1, not {}'.format(decimation_factor))
+	# Checked up front, so two workers can never be writing the same output at once
+	file_dirs = dict(zip(las_files, output_dirs(las_files, out_dir, las_dir)))
+	os.makedirs(out_dir, exist_ok = True)
+	workers = workers or os.cpu_count() or 1
+	process = partial(_decimate_file_safely, decimation_factor = decimation_factor, method = method, interval = interval)
+	start = time.perf_counter()
+
+	# Work out which files actually need doing
+	skipped = []
+	if incremental:
+		manifest = load_manifest(out_dir)
+		params = {'decimation_factor': decimation_factor, 'method': method, 'interval': interval}
+		signatures = {}
+		todo = []
+		for las_file in las_files:
+			key = os.path.abspath(las_file)
+			signatures[key] = fileSignature(las_file, verify)
+			entry = manifest.get(key)
+			if (entry is not None and entry['source'] == signatures[key] and entry['params'] == params
+					and os.path.exists(entry['output'])):
+				skipped.append(las_file)
+			else:
+				todo.append(las_file)
+		print('{} files unchanged since they were last decimated, {} to do'.format(len(skipped), len(todo)))
+	else:
+		todo = las_files
+
+	if workers == 1 or len(todo) < 2:
+		results = [process(las_file, file_dirs[las_file]) for las_file in todo]
+	else:
+		with ProcessPoolExecutor(max_workers = workers) as pool:
+			results = list(pool.map(process, todo, [file_dirs[las_file] for las_file in todo], chunksize = 4))
+	elapsed = time.perf_counter() - start
+
+	summary = {'processed': {}, 'skipped': skipped, 'failed': {}, 'samples_read': 0, 'samples_written': 0, 'seconds': elapsed}
+	for las_file, result, error in results:
+		key = os.path.abspath(las_file)
+		if error is not None:
+			summary['failed'][las_file] = error
+			print('Failed to decimate {}: {}'.format(las_file, error))
+			if incremental:
+				manifest.pop(key, None)
+			continue
+		out_path, nread, nwritten = result
+		summary['processed'][las_file] = out_path
+		summary['samples_read'] += nread
+		summary['samples_written'] += nwritten
+		if incremental:
+			manifest[key] = {'source': signatures[key], 'params': params, 'output': os.path.abspath(out_path)}
+	if incremental:
+		save_manifest(out_dir, manifest)
+	nfiles = len(summary['processed'])
+	rate = elapsed if elapsed > 0 else float('inf')
+	print('Decimated {} files ({} skipped, {} failed) in {:.2f} s with {} workers: {:.1f} files/sec, {:,.0f} samples/sec read'.format(
+		nfiles, len(skipped), len(summary['failed']), elapsed, workers, nfiles / rate, summary['samples_read'] / rate))
+	return summary
+
+
+def decimate_directory(las_dir, out_dir, decimation_factor, workers = None, recursive = True, method = 'stride', interval = None,
+					   incremental = False, verify = 'mtime'):
+	'''
+	Find all the .las files under las_dir and decimate them in parallel into out_dir, which mirrors the sub directories
+	of las_dir. See decimate_files().
+	'''
+	las_files = find_las_files(las_dir, recursive)
+	print('Found {} .las files in {}'.format(len(las_files), las_dir))
+	return decimate_files(las_files, out_dir, decimation_factor, workers, method, interval, incremental, verify, las_dir)
+
+
+def main(argv = None):
+	'''
+	Command line entry point
+	'''
+	parser = argparse.ArgumentParser(description = 'Reduce the number of depth samples in .LAS downhole log files.')
+	parser.add_argument('las_dir', help = 'directory containing the .LAS files (searched recursively)')
+	parser.add_argument('out_dir', help = 'directory to save the decimated .LAS files in')
+	parser.add_argument('-f', '--factor', type = float, default = 0.9,
+						help = 'share of the samples to remove, > 0 and < 1. 0.9 removes 9/10 samples (default 0.9)')
+	parser.add_argument('-w', '--workers', type = int, default = None,
+						help = 'number of worker processes (default: number of CPUs)')
+	parser.add_argument('-m', '--method', choices = METHODS, default = 'stride',
+						help = 'stride: keep every Nth sample, mean: block average, minmax: keep block extremes, '
+							   'resample: interpolate to a fixed depth interval (default stride)')
+	parser.add_argument('-i', '--interval', type = float, default = None, help = 'depth interval for the resample method')
+	parser.add_argument('--no-recurse', action = 'store_true', help = 'only look in las_dir itself, not its sub directories')
+	parser.add_argument('--incremental', action = 'store_true',
+						help = 'only decimate files that are new or have changed since the last run with the same settings')
+	parser.add_argument('--verify', choices = ('mtime', 'checksum'), default = 'mtime',
+						help = 'how to detect changed files in incremental mode: size and mtime, or size and SHA-1 (default mtime)')
+	args = parser.parse_args(argv)
+	summary = decimate_directory(args.las_dir, args.out_dir, args.factor, args.workers, not args.no_recurse,
+								 args.method, args.interval, args.incremental, args.verify)
+	return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+	raise SystemExit(main())
@@ -1,75 +1,343 @@
+import asyncio
+import hashlib
+import json
+import logging
 import os
-import shutil
+import pandas as pd
+import queue
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+from .instrumentation import stage
+
+logger = logging.getLogger(__name__)
 
 spatiallite_path = r'C:\Users\U19955\Desktop\mod_spatialite-4.3.0a-win-amd64'
 os.environ['PATH'] = spatiallite_path + ';' + os.environ['PATH']
 
 
-def makeCon(db_path):
+def workingCopyPath(db_path, cache_dir = None):
+    '''
+    The path of the users working copy of a database, ie the database name with a suffix of the users name.
+    
+    :param: db_path, the path to the spatialite database
+    :param: cache_dir, optional local directory to keep the working copy in. Defaults to alongside the database
+    
+    :return:
+    The path to the working copy
+    '''
+    userid = os.getlogin()
+    root, ext = os.path.splitext(db_path)
+    tmp_db_path = '{}_{}{}'.format(root, userid, ext or '.sqlite')
+    if cache_dir is not None:
+        tmp_db_path = os.path.join(cache_dir, os.path.basename(tmp_db_path))
+    return tmp_db_path
+
+def fileSignature(path, verify = 'mtime'):
+    '''
+    A cheap fingerprint of a file, used to tell if a database has changed since it was last copied.
+    
+    :param: path, the file to fingerprint
+    :param: verify, 'mtime' to use the size and modification time, or 'checksum' to use the size and a SHA-1 of the contents
+    
+    :return:
+    A dict describing the file
+    '''
+    stat = os.stat(path)
+    if verify == 'mtime':
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    elif verify == 'checksum':
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        return {'size': stat.st_size, 'sha1': sha1.hexdigest()}
+    else:
+        raise Exception('verify must be one of "mtime" or "checksum", not "{}"'.format(verify))
+
+def databaseSignature(db_path, verify = 'mtime'):
+    '''
+    The fingerprint of a database, see fileSignature(). For a database in WAL mode, committed writes sit in the
+    <db>-wal file until they are checkpointed, without touching the main file, so that is fingerprinted too.
+    
+    :return:
+    A dict of the signatures of the main file, and the -wal file (None if there isn't one)
+    '''
+    wal_path = db_path + '-wal'
+    return {'db': fileSignature(db_path, verify),
+            'wal': fileSignature(wal_path, verify) if os.path.exists(wal_path) else None}
+
+def loadSpatialite(con):
+    '''
+    Load the spatialite extension into a connection
+    '''
+    con.enable_load_extension(True)
+    con.load_extension("mod_spatialite")
+    return con
+
+def readOnlyUri(db_path, immutable = False):
+    '''
+    Build the sqlite URI to open a database file in place, read only.
+    If immutable, sqlite is also told the file can't change while it is open, so it skips all locking.
+    '''
+    uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(db_path)))
+    if immutable:
+        uri += '&immutable=1'
+    return uri
+
+def refreshWorkingCopy(db_path, tmp_db_path, verify = 'mtime'):
+    '''
+    Makes sure the working copy of a database is up to date with the source database.
+    
+    The signature of the source (and of the copy, as it was when made) is stored alongside the copy in a .json file.
+    If neither the source nor the copy has changed since, the existing copy is reused as is. Otherwise a consistent
+    snapshot of the source is taken with the sqlite online backup API, which is safe even if someone else is writing
+    to the source at the time, and swapped into place.
+    
+    :param: db_path, the path to the source spatialite database
+    :param: tmp_db_path, the path to the working copy
+    :param: verify, how to detect changes, see databaseSignature()
+    
+    :return:
+    True if the working copy was refreshed, False if the existing copy was reused
+    '''
+    manifest_path = tmp_db_path + '.json'
+    source_signature = databaseSignature(db_path, verify)
+    if os.path.exists(tmp_db_path) and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if (manifest.get('source') == source_signature and
+                manifest.get('copy') == fileSignature(tmp_db_path, 'mtime')):
+            return False
+    # Snapshot into a partial file first, so a failed refresh never leaves a half written working copy
+    part_path = tmp_db_path + '.part'
+    src = sqlite3.connect(readOnlyUri(db_path), uri = True)
+    dst = sqlite3.connect(part_path)
+    try:
+        src.backup(dst)
+        # Make sure the copy has the spatial metadata tables, before its signature is recorded
+        loadSpatialite(dst).cursor().execute("SELECT InitSpatialMetaData(1);")
+        dst.commit()
+    finally:
+        dst.close()
+        src.close()
+    os.replace(part_path, tmp_db_path)
+    with open(manifest_path, 'w') as f:
+        json.dump({'source': source_signature, 'copy': fileSignature(tmp_db_path, 'mtime')}, f)
+    return True
+
+def makeCon(db_path, mode = 'copy', verify = 'mtime', cache_dir = None):
     '''
     Wrapper about standard connection to SpatiaLite database code
     
-    To avoid the concurrent user limitations of sqlite databases, this code copies the
-    spatialite database to a new file with a suffix of the users name, and then creates
-    a connection to that database.
+    To avoid the concurrent user limitations of sqlite databases, this code by default works on a copy of
+    the spatialite database in a file with a suffix of the users name, and then creates a connection to that database.
     
+    The working copy is kept between sessions and only refreshed (with a consistent snapshot via the sqlite backup API)
+    when the source database has changed, or the copy has been modified, so connecting to an unchanged database is cheap.
     This means that the user is always accessing the latest version of the database.
     
+    Alternatively, mode = 'readonly' opens the source database in place, read only, which works well with WAL mode databases
+    that others may be writing to, and mode = 'immutable' additionally tells sqlite the file will not change while open,
+    so no locking is done at all. Neither makes a copy.
+    
     Note: should always be used inconjunction with the partner closeCon() function
     
+    The connection is logged, and in 'copy' mode the refresh of the working copy is measured as a 'copy' stage
+    (with the bytes copied, or 0 if the copy was reused), see the instrumentation module.
+    
     :param: db_path, the path to the spatialite database you wish to connect to
+    :param: mode, one of 'copy', 'readonly' or 'immutable'
+    :param: verify, how to detect changes to the source in 'copy' mode, 'mtime' (size and mtime) or 'checksum' (size and SHA-1)
+    :param: cache_dir, optional local directory for the working copy in 'copy' mode, eg to avoid working over a network share
     
     :return:
     con, the database connection object
     '''
-    userid = os.getlogin()
-    tmp_db_path = db_path.replace('.sqlite','_{}.sqlite'.format(userid))
-    shutil.copyfile(db_path, tmp_db_path)
-    con = sqlite3.connect(tmp_db_path)
-    con.enable_load_extension(True)
-    con.load_extension("mod_spatialite")
-    cur = con.cursor()
-    cur.execute("SELECT InitSpatialMetaData(1);")
-    print('Connected to {}. Temporary working copy created.'.format(db_path))
+    if mode == 'copy':
+        tmp_db_path = workingCopyPath(db_path, cache_dir)
+        with stage('copy', db = db_path, verify = verify) as metrics:
+            refreshed = refreshWorkingCopy(db_path, tmp_db_path, verify)
+            metrics.context['refreshed'] = refreshed
+            if refreshed:
+                metrics.add(bytes = os.path.getsize(tmp_db_path))
+        con = loadSpatialite(sqlite3.connect(tmp_db_path))
+        if refreshed:
+            logger.info('Connected to {}. Temporary working copy created.'.format(db_path))
+        else:
+            logger.info('Connected to {}. Existing working copy is up to date and was reused.'.format(db_path))
+    elif mode in ('readonly', 'immutable'):
+        con = loadSpatialite(sqlite3.connect(readOnlyUri(db_path, mode == 'immutable'), uri = True))
+        logger.info('Connected to {} in {} mode.'.format(db_path, mode))
+    else:
+        raise Exception('mode must be one of "copy", "readonly" or "immutable", not "{}"'.format(mode))
     return con
 
-def closeCon(con, db_path):
+def closeCon(con, db_path, remove_copy = False, cache_dir = None):
     '''
     Wrapper about standard close connection to SpatiaLite database code
     
-    This code closes the connection, and then deletes the temporary copy of the database
-    that was created as part of the makeCon() funciton.
+    This code closes the connection. The temporary copy of the database that was created as part of the makeCon()
+    function is kept for reuse by the next makeCon(), unless remove_copy is set.
     
     
     Note: should always be used inconjunction with the partner makeCon() function
     
     :param: con, the connection object wishing to be closed
     :param: db_path, the path to the spatialite database you wish to connect to
+    :param: remove_copy, delete the working copy as well
+    :param: cache_dir, the cache_dir passed to makeCon(), if any
     
     :return:
     None
     '''
+    forgetCatalogue(con)
     con.close()
-    userid = os.getlogin()
-    tmp_db_path = db_path.replace('.sqlite','_{}.sqlite'.format(userid))
-    os.remove(tmp_db_path)
-    print('Connection to {} is closed. Temporary working copy removed.'.format(db_path))
+    if remove_copy:
+        tmp_db_path = workingCopyPath(db_path, cache_dir)
+        for path in (tmp_db_path, tmp_db_path + '.json'):
+            if os.path.exists(path):
+                os.remove(path)
+        logger.info('Connection to {} is closed. Temporary working copy removed.'.format(db_path))
+    else:
+        logger.info('Connection to {} is closed.'.format(db_path))
     return
     
-def listTables(con, all = True):
+class SpatialiteConnectionPool(object):
     '''
-    Simple wrapper to list all the tables in a given database.
-    This has been setup to ignore the background tables in Spatialite.
+    A per-process pool of read only spatialite connections to a single database.
     
-    :param: con, a connection to a spatialite database
-    :param: all, a flag to allow the user to get all the tables, or just the non-spatialite specific ones
+    Connections are created on demand, up to size, and each one has the spatialite extension loaded once when it is
+    made, rather than on every connect. Connections are handed back to the pool after each use, so many small queries
+    can run without paying the connection and extension loading cost each time.
     
-    :return:
-    A list of all the table names
+    The async methods run the queries on a thread pool with one thread per connection, so that many independent lookups
+    can run concurrently from asyncio code, while the number of open connections stays bounded.
+    
+    eg:
+    with SpatialiteConnectionPool(db_path, size = 8) as pool:
+        rows = pool.query('SELECT ...', params)
+        results = asyncio.run(pool.queryManyAsync([(sql, params) for params in lookups]))
+    
+    :param: db_path, the path to the spatialite database
+    :param: size, the maximum number of connections (and worker threads)
+    :param: immutable, open the database as immutable, ie promise sqlite that it won't change while the pool is open
+    :param: timeout, seconds to wait for a free connection before raising, or None to wait forever
+    :param: prefill, create all the connections up front, rather than as they are first needed
     '''
-    tables = [table[0] for table in con.cursor().execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall()]
-    exclude_list = ['spatial_ref_sys',
+    def __init__(self, db_path, size = 4, immutable = False, timeout = None, prefill = False):
+        self.db_path = db_path
+        self.size = size
+        self.immutable = immutable
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._executor = None
+        if prefill:
+            for _ in range(size):
+                self._idle.put(self._connect())
+    
+    def _connect(self):
+        '''
+        Make a new connection, if the pool isn't already full
+        '''
+        with self._lock:
+            if len(self._connections) >= self.size:
+                return None
+            con = sqlite3.connect(readOnlyUri(self.db_path, self.immutable), uri = True, check_same_thread = False)
+            self._connections.append(loadSpatialite(con))
+        return con
+    
+    def acquire(self):
+        '''
+        Take a connection from the pool, making a new one if none are free and the pool isn't full,
+        otherwise waiting for one to be released.
+        '''
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        con = self._connect()
+        if con is not None:
+            return con
+        try:
+            return self._idle.get(timeout = self.timeout)
+        except queue.Empty:
+            raise Exception('Timed out waiting for a free connection to {}'.format(self.db_path))
+    
+    def release(self, con):
+        '''
+        Give a connection back to the pool
+        '''
+        self._idle.put(con)
+    
+    @contextmanager
+    def connection(self):
+        '''
+        Context manager that borrows a connection from the pool for the duration of the block
+        '''
+        con = self.acquire()
+        try:
+            yield con
+        finally:
+            self.release(con)
+    
+    def query(self, sql, params = ()):
+        '''
+        Run a single query on a pooled connection
+        
+        :return:
+        A list of the result rows
+        '''
+        with self.connection() as con:
+            return con.execute(sql, params).fetchall()
+    
+    async def queryAsync(self, sql, params = ()):
+        '''
+        Run a single query on a pooled connection, in a worker thread, without blocking the event loop
+        '''
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers = self.size, thread_name_prefix = 'spatialite')
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.query, sql, params)
+    
+    async def queryManyAsync(self, queries):
+        '''
+        Run many independent queries concurrently, at most size at a time
+        
+        :param: queries, an iterable of (sql, params) tuples
+        
+        :return:
+        A list of the results of each query, in the same order as the queries
+        '''
+        return await asyncio.gather(*[self.queryAsync(sql, params) for sql, params in queries])
+    
+    def close(self):
+        '''
+        Shut down the worker threads and close all of the connections
+        '''
+        if self._executor is not None:
+            self._executor.shutdown(wait = True)
+            self._executor = None
+        with self._lock:
+            for con in self._connections:
+                forgetCatalogue(con)
+                con.close()
+            self._connections = []
+        self._idle = queue.LifoQueue()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+# The background tables that spatialite makes in every database
+SPATIALITE_TABLES = ['spatial_ref_sys',
                      'spatialite_history',
                      'sqlite_sequence',
                      'geometry_columns',
@@ -89,9 +357,191 @@ def listTables(con, all = True):
                      'sql_statements_log',
                      'SpatialIndex',
                      'ElementaryGeometries']
-    if not all:
-        tables = [table for table in tables if table not in exlude_list]
-    return tables
+
+# The table in which pandas_spatialite.gpd_to_spatialite records the dtypes of the columns it writes
+PANDAS_DTYPES_TABLE = 'pandas_dtypes'
+# The table in which gpd_to_spatialite records the progress of checkpointed loads
+LOAD_CHECKPOINTS_TABLE = 'load_checkpoints'
+
+class SchemaCatalogue(object):
+    '''
+    A cached catalogue of the tables, columns, geometry columns and indexes in a database.
+    
+    All the metadata is read in one pass, using the sqlite table valued pragma functions, and kept until the schema
+    changes. Each lookup only checks PRAGMA schema_version, which sqlite bumps on every schema change, and re-reads
+    the catalogue if it has moved on. Use getCatalogue(con) to share one catalogue per connection.
+    
+    :param: con, a connection to a spatialite database
+    '''
+    def __init__(self, con):
+        self.con = con
+        self.schema_version = None
+        self.tables = []
+        self.columns = {}
+        self.geometry_columns = {}
+        self.indexes = {}
+        self.helper_tables = set()
+        self.index_tables = set()
+    
+    def refresh(self, force = False):
+        '''
+        Re-read the catalogue if the schema has changed since it was last read (or always, if force is set)
+        '''
+        cur = self.con.cursor()
+        version = cur.execute('PRAGMA schema_version').fetchone()[0]
+        if version == self.schema_version and not force:
+            return self
+        rows = cur.execute("SELECT name, coalesce(sql, '') LIKE 'CREATE VIRTUAL%' FROM sqlite_master WHERE type='table';").fetchall()
+        self.tables = [row[0] for row in rows]
+        self.columns = {table: [] for table in self.tables}
+        # Ordinary tables are all read in one statement. Virtual tables (eg SpatialIndex) are read one at a time, as reading
+        # one whose module isn't loaded (eg mod_spatialite) fails, and that shouldn't take the rest of the catalogue with it
+        for row in cur.execute("SELECT m.name, p.cid, p.name, p.type, p.\"notnull\", p.dflt_value, p.pk "
+                               "FROM sqlite_master m JOIN pragma_table_info(m.name) p "
+                               "WHERE m.type = 'table' AND coalesce(m.sql, '') NOT LIKE 'CREATE VIRTUAL%' "
+                               "ORDER BY m.name, p.cid").fetchall():
+            self.columns[row[0]].append(row[1:])
+        for table in [row[0] for row in rows if row[1]]:
+            try:
+                self.columns[table] = [row[:6] for row in cur.execute('SELECT cid, name, type, "notnull", dflt_value, pk '
+                                                                      'FROM pragma_table_info(?)', (table,)).fetchall()]
+            except sqlite3.OperationalError as e:
+                logger.debug('Skipped the columns of virtual table {}: {}'.format(table, e))
+        # Virtual tables have no indexes of their own
+        self.indexes = {table: {} for table in self.tables}
+        for table, index, unique, column in cur.execute("SELECT m.name, il.name, il.\"unique\", ii.name "
+                                                        "FROM sqlite_master m JOIN pragma_index_list(m.name) il "
+                                                        "JOIN pragma_index_info(il.name) ii "
+                                                        "WHERE m.type = 'table' AND coalesce(m.sql, '') NOT LIKE 'CREATE VIRTUAL%' "
+                                                        "ORDER BY m.name, il.name, ii.seqno").fetchall():
+            self.indexes[table].setdefault(index, {'unique': bool(unique), 'columns': []})['columns'].append(column)
+        try:
+            self.geometry_columns = {row[0].lower(): {'column': row[1], 'srid': row[2], 'spatial_index': bool(row[3])}
+                                     for row in cur.execute('SELECT f_table_name, f_geometry_column, srid, spatial_index_enabled '
+                                                            'FROM geometry_columns').fetchall()}
+        except sqlite3.OperationalError:
+            # Not a spatialite database
+            self.geometry_columns = {}
+        self.helper_tables = self._helperTables(cur)
+        self.index_tables = self._indexTables()
+        self.schema_version = version
+        return self
+    
+    def _helperTables(self, cur):
+        '''
+        The (lower case) names of the tables that gpd_to_spatialite keeps alongside the tables it writes:
+        the dtypes table, the category lookup tables of categorical columns, the row hashes of synced tables
+        and the progress of checkpointed loads
+        '''
+        names = {table.lower() for table in self.tables}
+        helpers = {LOAD_CHECKPOINTS_TABLE}
+        if PANDAS_DTYPES_TABLE in names:
+            helpers.add(PANDAS_DTYPES_TABLE)
+            helpers.update((table + '_' + col + '_categories').lower()
+                           for table, col in cur.execute('SELECT table_name, column_name FROM ' + PANDAS_DTYPES_TABLE +
+                                                         " WHERE encoding LIKE 'category%'").fetchall())
+        helpers.update(name + '_rowhash' for name in names if name + '_rowhash' in names)
+        return helpers & names
+
+    def _indexTables(self):
+        '''
+        The (lower case) names of the tables behind the spatialite spatial indexes, ie the idx_<table>_<geometry> R*Tree
+        of each geometry column with a spatial index, and its _node, _parent and _rowid shadow tables
+        '''
+        names = {table.lower() for table in self.tables}
+        tables = set()
+        for table, geom in self.geometry_columns.items():
+            if geom['spatial_index']:
+                rtree = 'idx_{}_{}'.format(table, geom['column']).lower()
+                tables.update(rtree + suffix for suffix in ('', '_node', '_parent', '_rowid'))
+        return tables & names
+
+    def listTables(self, all = True):
+        '''
+        The names of the tables in the database, optionally excluding the background tables: those of spatialite
+        (including the spatial indexes), those sqlite makes itself (eg sqlite_stat1, from ANALYZE) and the helper tables
+        kept by gpd_to_spatialite
+        '''
+        self.refresh()
+        if all:
+            return list(self.tables)
+        return [table for table in self.tables if table not in SPATIALITE_TABLES and not table.lower().startswith('sqlite_')
+                and table.lower() not in self.helper_tables and table.lower() not in self.index_tables]
+    
+    def listColumns(self, table_name):
+        '''
+        The names of the columns in a table
+        '''
+        self.refresh()
+        return [col[1] for col in self.columns.get(table_name, [])]
+    
+    def describeTable(self, table_name):
+        '''
+        A pandas DataFrame containing the details about each column in a table
+        '''
+        self.refresh()
+        desc = pd.DataFrame(self.columns.get(table_name, []),
+                            columns = ['column_num', 'column_name', 'data_type', 'not_null', 'default_value', 'is_primary_key'])
+        desc = desc.set_index('column_num', drop = True)
+        return desc
+    
+    def geometryColumn(self, table_name):
+        '''
+        The geometry column details (column, srid, spatial_index) of a table, or None if it isn't spatial
+        '''
+        self.refresh()
+        return self.geometry_columns.get(table_name.lower())
+    
+    def listIndexes(self, table_name):
+        '''
+        The indexes on a table, as a dict of index name: {'unique': bool, 'columns': [column names]}
+        '''
+        self.refresh()
+        return self.indexes.get(table_name, {})
+
+# One catalogue per connection, keyed on id() as sqlite3 connections can't be weakly referenced.
+# The connection is kept alongside so that its id can't be reused while the entry exists. closeCon() (and the other
+# helpers here that close connections) remove it with forgetCatalogue(), and the entries of connections closed any
+# other way are dropped the next time a catalogue is asked for.
+_catalogues = {}
+
+def _isClosed(con):
+    try:
+        con.total_changes
+    except sqlite3.ProgrammingError:
+        return True
+    return False
+
+def forgetCatalogue(con):
+    '''
+    Drop the shared SchemaCatalogue of a connection, eg when it is about to be closed
+    '''
+    _catalogues.pop(id(con), None)
+
+def getCatalogue(con):
+    '''
+    Get the shared SchemaCatalogue for a connection, creating it the first time
+    '''
+    for key, (other, _) in list(_catalogues.items()):
+        if _isClosed(other):
+            del _catalogues[key]
+    entry = _catalogues.get(id(con))
+    if entry is None:
+        entry = _catalogues[id(con)] = (con, SchemaCatalogue(con))
+    return entry[1]
+
+def listTables(con, all = True):
+    '''
+    Simple wrapper to list all the tables in a given database.
+    This has been setup to ignore the background tables in Spatialite.
+    
+    :param: con, a connection to a spatialite database
+    :param: all, a flag to allow the user to get all the tables, or just the non-spatialite specific ones
+    
+    :return:
+    A list of all the table names
+    '''
+    return getCatalogue(con).listTables(all)
 
 def listColumns(table_name, con):
     '''
@@ -103,8 +553,7 @@ def listColumns(table_name, con):
     :return:
     A list of all the columns in the requested table
     '''
-    cols = [row[1] for row in con.cursor().execute("pragma table_info('{}')".format(table_name)).fetchall()]
-    return cols
+    return getCatalogue(con).listColumns(table_name)
     
 def describeTable(table_name, con):
     '''
@@ -116,7 +565,4 @@ def describeTable(table_name, con):
     :return:
     A pandas DataFrame containing the details about each column
     '''
-    desc = pd.DataFrame(con.cursor().execute("pragma table_info('{}')".format(table_name).fetchall()))
-    desc.columns = ['column_num', 'column_name', 'is_nullable','default_value','is_primary_key']
-    desc = desc.set_index('column_num', drop = True)
-    return desc
\ No newline at end of file
+    return getCatalogue(con).describeTable(table_name)
@@ -0,0 +1,180 @@
+'''
+Vectorized decimation and resampling of downhole log curves.
+
+All of the functions work on a 1D depth array and a 1D (one curve) or 2D (samples x curves) data array,
+and return a new (depth, data) pair. Everything is done with whole array NumPy operations, so there is no
+per-sample python work, even for logs with millions of samples and many curves.
+
+The decimation factor follows the convention of the LASdecimator: it is the share of the samples to remove,
+so 0.5 removes every second sample and 0.9 removes 9/10 samples. Factors where 1 / (1 - factor) isn't a whole
+number keep the intended share of the samples, as evenly spaced as whole samples allow.
+'''
+import numpy as np
+
+METHODS = ('stride', 'mean', 'minmax', 'resample')
+
+
+def _as_2d(data):
+    '''
+    View 1D data as a single column, so every function can treat the curves the same way
+    '''
+    data = np.asarray(data, dtype = float)
+    return data[:, np.newaxis] if data.ndim == 1 else data
+
+
+def _like(result, data):
+    '''
+    Return result with the same number of dimensions as the original data
+    '''
+    return result[:, 0] if np.ndim(data) == 1 else result
+
+
+def keep_indices(nsamples, decimation_factor):
+    '''
+    The indices of the samples to keep when removing decimation_factor of the samples, from the first sample on.
+    The spacing depends only on the factor, not on the length of the log: when 1 / (1 - decimation_factor) is a whole
+    number N it is exactly every Nth sample, so a regularly sampled log stays regularly sampled, otherwise it is
+    sample round(i * N) for non integer N.
+
+    :param: nsamples, the number of samples in the log
+    :param: decimation_factor, the share of the samples to remove, >= 0 and < 1
+
+    :return:
+    An integer array of the indices to keep
+    '''
+    if not 0 <= decimation_factor < 1:
+        raise Exception('The decimation factor must be >= 0 and < 1, not {}'.format(decimation_factor))
+    step = 1 / (1 - decimation_factor)
+    # The small tolerance stops eg 1 / (1 - 0.9) = 9.999999999999998 missing out on being a whole number
+    if abs(step - round(step)) < 1e-9:
+        return np.arange(0, nsamples, int(round(step)))
+    idx = np.round(np.arange(int(np.ceil(nsamples / step))) * step).astype(int)
+    return idx[idx < nsamples]
+
+
+def block_size(decimation_factor):
+    '''
+    The number of samples per block for the block based methods, ie the nearest whole number of samples
+    that one sample (or min/max pair) should stand in for.
+    '''
+    if not 0 <= decimation_factor < 1:
+        raise Exception('The decimation factor must be >= 0 and < 1, not {}'.format(decimation_factor))
+    return max(1, int(round(1 / (1 - decimation_factor))))
+
+
+def decimate_stride(depth, data, decimation_factor):
+    '''
+    Keep an evenly spaced subset of the samples (ie keep every Nth sample, for non integer N as well).
+    The kept samples are the original values at their original depths.
+    '''
+    idx = keep_indices(len(depth), decimation_factor)
+    return np.asarray(depth)[idx], np.asarray(data)[idx]
+
+
+def decimate_block_mean(depth, data, decimation_factor):
+    '''
+    Average the samples in consecutive blocks, which anti-aliases the curves rather than just dropping samples.
+    Each block is represented by the mean depth and the mean of each curve, ignoring missing (NaN) values.
+    The last block may be shorter than the rest.
+    '''
+    block = block_size(decimation_factor)
+    values = _as_2d(data)
+    depth = np.asarray(depth, dtype = float)
+    nblocks = -(-len(depth) // block)
+    # Block sums over the valid samples only, via reduceat on the start of each block
+    starts = np.arange(nblocks) * block
+    valid = (~np.isnan(values)).astype(int)
+    sums = np.add.reduceat(np.where(valid > 0, values, 0.0), starts, axis = 0) if nblocks else np.zeros((0, values.shape[1]))
+    counts = np.add.reduceat(valid, starts, axis = 0) if nblocks else np.zeros((0, values.shape[1]))
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        means = sums / counts
+    new_depth = np.add.reduceat(depth, starts) / np.diff(np.append(starts, len(depth))) if nblocks else depth[:0]
+    return new_depth, _like(means, data)
+
+
+def decimate_minmax(depth, data, decimation_factor):
+    '''
+    Keep the samples holding the minimum and maximum of each curve within consecutive blocks, so peaks and troughs
+    survive the decimation. The samples kept are shared across the curves (the union of every curves extremes),
+    so there can be up to 2 x number of curves samples per block, at their original depths and values.
+    '''
+    block = block_size(decimation_factor)
+    values = _as_2d(data)
+    nsamples, ncurves = values.shape
+    nblocks = -(-nsamples // block)
+    # Pad to whole blocks, with values that can never be chosen as a min or max
+    pad = nblocks * block - nsamples
+    low = np.pad(np.where(np.isnan(values), np.inf, values), ((0, pad), (0, 0)), constant_values = np.inf)
+    high = np.pad(np.where(np.isnan(values), -np.inf, values), ((0, pad), (0, 0)), constant_values = -np.inf)
+    offsets = np.arange(nblocks)[:, np.newaxis] * block
+    argmin = low.reshape(nblocks, block, ncurves).argmin(axis = 1) + offsets
+    argmax = high.reshape(nblocks, block, ncurves).argmax(axis = 1) + offsets
+    idx = np.unique(np.concatenate([argmin.ravel(), argmax.ravel()]))
+    idx = idx[idx < nsamples]
+    return np.asarray(depth)[idx], np.asarray(data)[idx]
+
+
+def resample_depth(depth, data, interval, start = None, stop = None):
+    '''
+    Linearly interpolate the curves onto a regular depth interval, eg to bring logs with different or irregular
+    sampling onto the same depths. Samples that fall within (or next to) a gap in a curve are left missing (NaN).
+
+    :param: depth, the depth of each sample, increasing or decreasing
+    :param: data, the curve values
+    :param: interval, the new depth spacing, in the same units as depth
+    :param: start, stop, optional depth range. Default to the first and last depths of the log
+    '''
+    if interval <= 0:
+        raise Exception('The resampling interval must be > 0, not {}'.format(interval))
+    depth = np.asarray(depth, dtype = float)
+    values = _as_2d(data)
+    # np.interp needs increasing depths
+    if len(depth) > 1 and depth[0] > depth[-1]:
+        depth, values = depth[::-1], values[::-1]
+    start = depth[0] if start is None else start
+    stop = depth[-1] if stop is None else stop
+    new_depth = start + np.arange(int(np.floor((stop - start) / interval + 1e-9)) + 1) * interval
+    missing = np.isnan(values)
+    filled = np.where(missing, 0.0, values)
+    result = np.empty((len(new_depth), values.shape[1]))
+    for i in range(values.shape[1]):
+        result[:, i] = np.interp(new_depth, depth, filled[:, i], left = np.nan, right = np.nan)
+        # Any contribution from a missing sample makes the interpolated value missing too
+        gap = np.interp(new_depth, depth, missing[:, i].astype(float), left = 1.0, right = 1.0)
+        result[gap > 0, i] = np.nan
+    return new_depth, _like(result, data)
+
+
+def decimate(depth, data, decimation_factor = None, method = 'stride', interval = None):
+    '''
+    Decimate or resample log curves with the chosen method:
+        'stride': keep an evenly spaced share of the original samples
+        'mean': average consecutive blocks of samples (anti-aliased)
+        'minmax': keep the samples holding the min and max of each curve in consecutive blocks
+        'resample': interpolate onto a regular depth interval, given by interval rather than decimation_factor
+
+    :param: depth, 1D array of the sample depths
+    :param: data, 1D or 2D (samples x curves) array of the curve values
+    :param: decimation_factor, the share of the samples to remove, >= 0 and < 1
+    :param: method, one of METHODS
+    :param: interval, the new depth spacing for the 'resample' method
+
+    :return:
+    A tuple of the new depth and data arrays
+    '''
+    if len(depth) != len(data):
+        raise Exception('depth and data must have the same number of samples, not {} and {}'.format(len(depth), len(data)))
+    if method == 'resample':
+        if interval is None:
+            raise Exception('An interval must be given for the resample method')
+        return resample_depth(depth, data, interval)
+    if decimation_factor is None:
+        raise Exception('A decimation factor must be given for the {} method'.format(method))
+    if method == 'stride':
+        return decimate_stride(depth, data, decimation_factor)
+    elif method == 'mean':
+        return decimate_block_mean(depth, data, decimation_factor)
+    elif method == 'minmax':
+        return decimate_minmax(depth, data, decimation_factor)
+    else:
+        raise Exception('method must be one of {}, not "{}"'.format(METHODS, method))
@@ -0,0 +1,222 @@
+'''
+Timing and profiling instrumentation for the database helpers.
+
+The loading and connection helpers are split into stages (create, populate, geometry, index, commit, copy, ...), and each
+stage records its wall time, the rows it processed, the bytes it wrote or copied and the number of SQL statements it sent.
+Every finished stage is logged at INFO level through the 'generic_utils.instrumentation' logger, and passed to any metrics
+hooks, so the numbers can be collected without parsing log text:
+
+    logging.basicConfig(level = logging.INFO)
+
+    metrics = []
+    with instrumented(hook = metrics.append):
+        gpd_to_spatialite(df, con, 'boreholes')
+    pd.DataFrame([m.as_dict() for m in metrics])
+
+Two opt-in modes help find where the time goes within a stage:
+    profile, runs the outermost stage under cProfile, and keeps the top of the cumulative time listing on the metrics
+    trace_sql, traces every statement run on the connection, and keeps the slowest. The time of a statement is taken as
+        the time until the next statement starts, so it includes any python work in between, and is only approximate.
+Both slow things down, so they are off unless asked for.
+'''
+import cProfile
+import io
+import logging
+import pstats
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Functions called with the StageMetrics of every finished stage
+_hooks = []
+_options = {'profile': False, 'trace_sql': False, 'top': 20}
+# Whether a profiler is running, as cProfile profilers can't be nested
+_profiling = [False]
+# Connections being traced, by id, so nested stages on the same connection share the one tracer
+_tracers = {}
+
+
+class StageMetrics(object):
+    '''
+    The measurements of one stage.
+
+    :param: name, the name of the stage, eg 'populate'
+    :param: context, any identifying details, eg table = 'boreholes'
+    '''
+    def __init__(self, name, **context):
+        self.name = name
+        self.context = context
+        self.seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.statements = 0
+        self.profile = None
+        self.slow_statements = None
+
+    def add(self, rows = 0, bytes = 0, statements = 0):
+        '''
+        Add to the counts of the stage
+        '''
+        self.rows += rows
+        self.bytes += bytes
+        self.statements += statements
+
+    def as_dict(self):
+        '''
+        The measurements as a flat dict, eg for building a DataFrame of many stages
+        '''
+        d = {'stage': self.name}
+        d.update(self.context)
+        d.update({'seconds': self.seconds, 'rows': self.rows, 'bytes': self.bytes, 'statements': self.statements})
+        return d
+
+    def __str__(self):
+        context = ' '.join('{}={}'.format(key, value) for key, value in self.context.items())
+        s = '{} {}: {:.3f} s'.format(self.name, context, self.seconds) if context else '{}: {:.3f} s'.format(self.name, self.seconds)
+        if self.rows:
+            s += ', {:,} rows'.format(self.rows)
+            if self.seconds > 0:
+                s += ' ({:,.0f} rows/sec)'.format(self.rows / self.seconds)
+        if self.bytes:
+            s += ', {:,} bytes'.format(self.bytes)
+        if self.statements:
+            s += ', {:,} statements'.format(self.statements)
+        return s
+
+
+def add_metrics_hook(hook):
+    '''
+    Call hook with the StageMetrics of every stage that finishes from now on
+
+    :return:
+    The hook, so this can be used as a decorator
+    '''
+    _hooks.append(hook)
+    return hook
+
+
+def remove_metrics_hook(hook):
+    '''
+    Stop calling a hook added with add_metrics_hook()
+    '''
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+@contextmanager
+def instrumented(hook = None, profile = False, trace_sql = False, top = 20):
+    '''
+    Context manager to collect the stage metrics, and optionally profile, for the code inside the block.
+
+    :param: hook, optional function called with the StageMetrics of each stage that finishes in the block
+    :param: profile, run the outermost stage under cProfile
+    :param: trace_sql, trace the SQL statements of the stages that are given a connection
+    :param: top, the number of profile lines and slowest statements to keep
+    '''
+    previous = dict(_options)
+    _options.update({'profile': profile, 'trace_sql': trace_sql, 'top': top})
+    if hook is not None:
+        add_metrics_hook(hook)
+    try:
+        yield
+    finally:
+        if hook is not None:
+            remove_metrics_hook(hook)
+        _options.update(previous)
+
+
+def emit(metrics):
+    '''
+    Log a finished stage and pass it on to the metrics hooks. A failing hook is logged rather than raised,
+    so the instrumentation can never break the work being measured.
+    '''
+    logger.info(str(metrics))
+    if metrics.profile:
+        logger.info('Profile of %s:\n%s', metrics.name, metrics.profile)
+    if metrics.slow_statements:
+        logger.info('Slowest statements of %s:\n%s', metrics.name,
+                    '\n'.join('{:10.4f} s  {}'.format(seconds, sql) for seconds, sql in metrics.slow_statements))
+    for hook in list(_hooks):
+        try:
+            hook(metrics)
+        except Exception:
+            logger.exception('Metrics hook %r failed', hook)
+
+
+class _SQLTracer(object):
+    '''
+    Times the statements run on a connection, through the sqlite3 trace callback
+    '''
+    def __init__(self, con):
+        self.con = con
+        self.times = {}
+        self.last = None
+
+    def _callback(self, sql):
+        now = time.perf_counter()
+        self._close_last(now)
+        self.last = (sql, now)
+        logger.debug(sql)
+
+    def _close_last(self, now):
+        if self.last is not None:
+            sql, start = self.last
+            self.times[sql] = self.times.get(sql, 0.0) + now - start
+            self.last = None
+
+    def start(self):
+        self.con.set_trace_callback(self._callback)
+
+    def stop(self, top):
+        self._close_last(time.perf_counter())
+        self.con.set_trace_callback(None)
+        return sorted(((seconds, sql) for sql, seconds in self.times.items()), reverse = True)[:top]
+
+
+@contextmanager
+def stage(name, con = None, **context):
+    '''
+    Context manager that measures a stage, and emits its metrics when it ends (even if it fails).
+    The block gets the StageMetrics, to add its rows, bytes and statement counts to.
+
+    :param: name, the name of the stage
+    :param: con, optional connection the stage works on, for trace_sql
+    :param: context, any identifying details to record with the metrics, eg table = 'boreholes'
+    '''
+    metrics = StageMetrics(name, **context)
+    profiler = None
+    if _options['profile'] and not _profiling[0]:
+        profiler = cProfile.Profile()
+        _profiling[0] = True
+    tracer = None
+    if _options['trace_sql'] and con is not None and id(con) not in _tracers:
+        tracer = _tracers[id(con)] = _SQLTracer(con)
+        tracer.start()
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield metrics
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            _profiling[0] = False
+            out = io.StringIO()
+            pstats.Stats(profiler, stream = out).sort_stats('cumulative').print_stats(_options['top'])
+            metrics.profile = out.getvalue()
+        metrics.seconds = time.perf_counter() - start
+        if tracer is not None:
+            del _tracers[id(con)]
+            metrics.slow_statements = tracer.stop(_options['top'])
+        emit(metrics)
+
+
+def database_bytes(cur):
+    '''
+    The size of the database the cursor is on, in bytes, from its page count.
+    Cheap enough to take before and after a stage, to measure how much the stage wrote.
+    '''
+    page_count = cur.execute('PRAGMA page_count').fetchone()[0]
+    page_size = cur.execute('PRAGMA page_size').fetchone()[0]
+    return page_count * page_size
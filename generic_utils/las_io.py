@@ -0,0 +1,163 @@
+'''
+Fast reading and writing of .LAS downhole log files.
+
+lasio is only used to parse the header sections, and is only given the header text. The ~A (ASCII data) section is
+memory mapped and parsed straight into NumPy arrays a block of lines at a time, and written back out with one formatting
+operation per block of rows, so the data never goes through per value python objects or a DataFrame, and only one
+block of the text is ever copied out of the file at once. Wrapped files, or data sections that don't parse as plain numbers, fall
+back to reading the data with lasio.
+'''
+import mmap
+import re
+import warnings
+
+import numpy as np
+import lasio
+
+# The line starting the ~A (ASCII data) section, eg "~A  DEPT  GR" or "~ASCII"
+_DATA_SECTION = re.compile(rb'^~A[^\r\n]*\r?\n?', re.MULTILINE | re.IGNORECASE)
+
+# Rows formatted per block when writing, to bound the memory used by the formatted text
+_WRITE_BLOCK_ROWS = 20000
+
+# Bytes of the data section parsed per block when reading, to bound the memory used by the copied text
+_READ_BLOCK_BYTES = 1 << 24
+
+
+def _header_value(las, mnemonic, default = None):
+    '''
+    Get a value from the ~W (well) section of a lasio LASFile, or default if it isn't there
+    '''
+    try:
+        return las.well[mnemonic].value
+    except (KeyError, AttributeError):
+        return default
+
+
+def read_las(path):
+    '''
+    Read a .las file, parsing the header with lasio and the data section directly with NumPy.
+
+    :param: path, the path to the .las file
+
+    :return:
+    A tuple of (las, data), where las is the lasio LASFile holding the headers and curve definitions,
+    and data is a 2D float array of samples x curves (depth first), with the null values as NaN
+    '''
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+        match = _DATA_SECTION.search(mm)
+        if match is None:
+            raise Exception('No ~A data section found in {}'.format(path))
+        # Only the header text goes to lasio, so it doesn't scan through the data as well
+        las = lasio.read(mm[:match.start()].decode('latin-1'), ignore_data = True)
+        ncurves = len(las.curves)
+        if str(_header_value(las, 'WRAP', 'NO')).strip().upper() == 'YES':
+            return _read_las_with_lasio(path)
+        values = _parse_values(mm, match.end())
+    if values is None:
+        return _read_las_with_lasio(path)
+    if ncurves == 0 or values.size % ncurves != 0:
+        return _read_las_with_lasio(path)
+    data = values.reshape(-1, ncurves)
+    null = _header_value(las, 'NULL')
+    if null is not None and null != '':
+        data[data == float(null)] = np.nan
+    return las, data
+
+
+def _parse_values(mm, start):
+    '''
+    Parse the numbers from start to the end of a memory mapped file, a block of whole lines at a time.
+
+    :return:
+    A 1D float array of all the values, or None if the text isn't all plain numbers
+    '''
+    pieces = []
+    # fromstring treats any run of whitespace (including new lines) as the separator.
+    # Anything that isn't a plain number stops the parse early with a warning, so let lasio deal with those files
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        while start < len(mm):
+            stop = min(start + _READ_BLOCK_BYTES, len(mm))
+            if stop < len(mm):
+                newline = mm.rfind(b'\n', start, stop)
+                if newline > start:
+                    stop = newline + 1
+            block = mm[start:stop]
+            start = stop
+            # fromstring reads blank text as a single -1, rather than as nothing
+            if not block.strip():
+                continue
+            try:
+                pieces.append(np.fromstring(block, dtype = float, sep = ' '))
+            except DeprecationWarning:
+                return None
+    return np.concatenate(pieces) if pieces else np.zeros(0)
+
+
+def _read_las_with_lasio(path):
+    '''
+    The slow, but fully general, fallback: have lasio read the whole file
+    '''
+    las = lasio.read(path)
+    return las, np.asarray(las.data, dtype = float)
+
+
+def _set_header_line(header, mnemonic, value):
+    '''
+    Replace the value on a "MNEM.UNIT  VALUE : DESCRIPTION" header line, keeping the rest of the line as is
+    '''
+    pattern = re.compile(rb'^(\s*' + mnemonic + rb'\s*\.\S*\s+)([^:\r\n]*?)(\s*:)', re.MULTILINE | re.IGNORECASE)
+    return pattern.sub(lambda m: m.group(1) + value.encode('ascii') + m.group(3), header, count = 1)
+
+
+def write_las(out_path, src_path, data, null_value = None, fmt = '%.5f'):
+    '''
+    Write log data to a .las file, using the header sections of an existing .las file.
+
+    The header text of src_path is copied across as is, apart from STRT, STOP and STEP, which are updated to match
+    the new data (STEP is 0 if the depths aren't evenly spaced), and WRAP, which is set to NO as the data is always
+    written one sample per line. The data is formatted in blocks of rows with a single % operation per block.
+
+    :param: out_path, the path to write to
+    :param: src_path, the .las file to take the headers from. Must have the same curves as data
+    :param: data, 2D float array of samples x curves (depth first), with missing values as NaN
+    :param: null_value, the value to write for missing values. Defaults to the NULL value in the source header, or -999.25
+    :param: fmt, the % format for each value
+
+    :return:
+    None
+    '''
+    with open(src_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+        match = _DATA_SECTION.search(mm)
+        if match is None:
+            raise Exception('No ~A data section found in {}'.format(src_path))
+        header = mm[:match.start()]
+        data_line = mm[match.start():match.end()]
+    newline = '\r\n' if b'\r\n' in data_line or b'\r\n' in header[:4096] else '\n'
+    if not data_line.endswith(b'\n'):
+        data_line += newline.encode('ascii')
+
+    if null_value is None:
+        null_match = re.search(rb'^\s*NULL\s*\.\S*\s+([^:\r\n]*?)\s*:', header, re.MULTILINE | re.IGNORECASE)
+        null_value = float(null_match.group(1)) if null_match else -999.25
+    data = np.asarray(data, dtype = float)
+    if data.ndim != 2:
+        raise Exception('data must be a 2D array of samples x curves')
+    depth = data[:, 0]
+    if len(depth):
+        steps = np.diff(depth)
+        step = steps[0] if len(steps) and np.allclose(steps, steps[0]) else 0
+        header = _set_header_line(header, rb'STRT', fmt % depth[0])
+        header = _set_header_line(header, rb'STOP', fmt % depth[-1])
+        header = _set_header_line(header, rb'STEP', fmt % step)
+    header = _set_header_line(header, rb'WRAP', 'NO')
+    data = np.where(np.isnan(data), null_value, data)
+
+    row_fmt = ' '.join([fmt] * data.shape[1]) + newline
+    with open(out_path, 'wb') as f:
+        f.write(header)
+        f.write(data_line)
+        for start in range(0, len(data), _WRITE_BLOCK_ROWS):
+            block = data[start:start + _WRITE_BLOCK_ROWS]
+            f.write(((row_fmt * len(block)) % tuple(block.ravel().tolist())).encode('ascii'))
@@ -0,0 +1,195 @@
+'''
+Bulk load .LAS downhole log curves into an indexed SpatiaLite (or plain SQLite) curve store.
+
+The curve data is streamed one file at a time, optionally decimated on the way, into either:
+    a long table, with one row per (well, depth, curve, value), which suits any mix of curves across wells, or
+    a wide table, with one row per (well, depth) and a column per curve, where new curves become new columns.
+Either way there is a composite index on (well, depth), so depth interval queries across thousands of wells are
+indexed lookups. The well headers go into a second table, with the well location as a point geometry.
+
+The tables are written with pandas_spatialite.gpd_to_spatialite, so they get the same bulk load path as everything else.
+'''
+import logging
+import os
+import re
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import Point
+
+from .db_utils import forgetCatalogue, listColumns, loadSpatialite
+from .decimation import decimate
+from .las_io import read_las
+from .pandas_spatialite import gpd_to_spatialite
+
+logger = logging.getLogger(__name__)
+
+LAYOUTS = ('long', 'wide')
+
+
+def _well_value(las, mnemonic):
+    '''
+    A value from the ~W (well) section, or None if it is missing or blank
+    '''
+    try:
+        value = las.well[mnemonic].value
+    except (KeyError, AttributeError):
+        return None
+    return None if value == '' else value
+
+
+def _column_name(mnemonic):
+    '''
+    Make a curve mnemonic safe to use as a column name in the wide layout, eg 'GR:1' becomes 'GR_1'
+    '''
+    name = re.sub(r'\W', '_', mnemonic.strip())
+    return name if name and not name[0].isdigit() else 'c_' + name
+
+
+def well_name(las, las_file):
+    '''
+    The name used for a well: the UWI if there is one, otherwise the WELL name, otherwise the file name
+    '''
+    for mnemonic in ('UWI', 'WELL'):
+        value = _well_value(las, mnemonic)
+        if value is not None:
+            return str(value)
+    return os.path.splitext(os.path.basename(las_file))[0]
+
+
+def well_location(las, x_field = 'LONG', y_field = 'LATI'):
+    '''
+    The well location as a Point, or None if either coordinate is missing or isn't a plain number (eg a DMS string)
+    '''
+    try:
+        return Point(float(_well_value(las, x_field)), float(_well_value(las, y_field)))
+    except (TypeError, ValueError):
+        return None
+
+
+def curves_frame(well, depth, curves, data, layout = 'long'):
+    '''
+    Turn the curve arrays of one well into a DataFrame in the chosen layout.
+    In the long layout the missing (NaN) values are left out, as there is nothing to store.
+
+    :param: well, the well name
+    :param: depth, 1D array of the sample depths
+    :param: curves, the names of the curves
+    :param: data, 2D array of samples x curves
+    :param: layout, 'long' or 'wide'
+    '''
+    if layout == 'wide':
+        df = pd.DataFrame(data, columns = [_column_name(curve) for curve in curves])
+        df.insert(0, 'depth', depth)
+        df.insert(0, 'well', well)
+        return df
+    elif layout == 'long':
+        nsamples, ncurves = data.shape
+        values = data.ravel()
+        keep = ~np.isnan(values)
+        return pd.DataFrame({'well': well,
+                             'depth': np.repeat(depth, ncurves)[keep],
+                             'curve': np.tile(np.asarray(curves, dtype = object), nsamples)[keep],
+                             'value': values[keep]})
+    else:
+        raise Exception('layout must be one of {}, not "{}"'.format(LAYOUTS, layout))
+
+
+def load_las_to_spatialite(las_files, con, table = 'las_curves', header_table = 'las_wells', layout = 'long',
+                           x_field = 'LONG', y_field = 'LATI', epsg = 4326, decimation_factor = None,
+                           method = 'stride', interval = None, batch_size = 50000):
+    '''
+    Stream the curves of many .las files into a curve table, and their headers into a well table, in a spatialite database.
+    Both tables are created if they don't exist, and appended to if they do.
+
+    :param: las_files, the paths of the .las files to load
+    :param: con, a connection to the spatialite database to load into, or a path to one (opened with the spatialite extension)
+    :param: table, the name of the curve table
+    :param: header_table, the name of the well header table
+    :param: layout, 'long' for one row per (well, depth, curve, value), or 'wide' for one row per (well, depth)
+    :param: x_field, y_field, the ~W mnemonics holding the well location. Wells without them, or where they aren't
+            plain numbers (eg DMS strings), get a NULL geometry
+    :param: epsg, the EPSG code of the well locations
+    :param: decimation_factor, method, interval, optionally decimate the curves on the way, see decimation.decimate()
+    :param: batch_size, the number of rows per executemany batch
+
+    :return:
+    A dict with the number of wells and curve rows loaded, and the files that failed (and their errors)
+    '''
+    if layout not in LAYOUTS:
+        raise Exception('layout must be one of {}, not "{}"'.format(LAYOUTS, layout))
+    own_con = not isinstance(con, sqlite3.Connection)
+    if own_con:
+        con = loadSpatialite(sqlite3.connect(con))
+        con.cursor().execute("SELECT InitSpatialMetaData(1);")
+    cur = con.cursor()
+
+    def nextOID(tablename):
+        # Carry the primary key on from any rows already in the table
+        try:
+            return (cur.execute('SELECT max(OID) FROM ' + tablename).fetchone()[0] or 0) + 1
+        except sqlite3.OperationalError:
+            return 1
+
+    summary = {'wells': 0, 'rows': 0, 'failed': {}}
+    headers = []
+
+    def curveChunks():
+        '''
+        Read, decimate and reshape one file at a time, so only one file's curves are ever in memory
+        '''
+        oid = nextOID(table)
+        for las_file in las_files:
+            # Anything going wrong with a file (reading, decimating, ...) skips just that file
+            try:
+                las, data = read_las(las_file)
+                well = well_name(las, las_file)
+                depth, values = data[:, 0], data[:, 1:]
+                if decimation_factor is not None or method == 'resample':
+                    depth, values = decimate(depth, values, decimation_factor, method, interval)
+                curves = [curve.mnemonic for curve in las.curves][1:]
+                df = curves_frame(well, depth, curves, values, layout)
+                if layout == 'wide':
+                    # New curves become new columns in the existing table
+                    existing = listColumns(table, con)
+                    if existing:
+                        for col in df.columns:
+                            if col not in existing:
+                                cur.execute('ALTER TABLE ' + table + ' ADD COLUMN ' + col + ' REAL')
+                header = {'well': well,
+                          'file': os.path.abspath(las_file),
+                          'strt': float(depth[0]) if len(depth) else None,
+                          'stop': float(depth[-1]) if len(depth) else None,
+                          'nsamples': len(depth),
+                          'curves': ','.join(curves),
+                          'geometry': well_location(las, x_field, y_field)}
+            except Exception as e:
+                summary['failed'][las_file] = '{}: {}'.format(type(e).__name__, e)
+                logger.warning('Failed to load {}: {}'.format(las_file, summary['failed'][las_file]))
+                continue
+            df.index = pd.RangeIndex(oid, oid + len(df), name = 'OID')
+            oid += len(df)
+            headers.append(header)
+            summary['wells'] += 1
+            summary['rows'] += len(df)
+            yield df
+
+    # The (well, depth) index makes depth interval queries on a well indexed lookups
+    gpd_to_spatialite(curveChunks(), con, table, if_exists = 'append', batch_size = batch_size,
+                      indexes = [('well', 'depth')])
+
+    if headers:
+        oid = nextOID(header_table)
+        header_df = gpd.GeoDataFrame(headers, index = pd.RangeIndex(oid, oid + len(headers), name = 'OID'),
+                                     geometry = 'geometry', crs = 'epsg:{}'.format(epsg))
+        gpd_to_spatialite(header_df, con, header_table, epsg = epsg, if_exists = 'append', batch_size = batch_size,
+                          indexes = ['well'])
+    cur.close()
+    if own_con:
+        forgetCatalogue(con)
+        con.close()
+    logger.info('Loaded {:,} curve rows from {} wells into {} ({} files failed)'.format(
+        summary['rows'], summary['wells'], table, len(summary['failed'])))
+    return summary
@@ -3,247 +3,888 @@ import pandas as pd
 import geopandas as gpd
 import sqlite3
 import shapely
+import itertools
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 
-def gpd_to_spatialite(df, con, tablename, epsg = None):
+from .db_utils import LOAD_CHECKPOINTS_TABLE, PANDAS_DTYPES_TABLE
+from .instrumentation import StageMetrics, database_bytes, emit, stage
+
+logger = logging.getLogger(__name__)
+
+# PRAGMAs applied to the connection for the duration of a bulk load, and restored afterwards.
+# These trade crash safety for speed, which is acceptable while a new table is being built.
+BULK_LOAD_PRAGMAS = {'synchronous': 'OFF',
+                     'journal_mode': 'MEMORY',
+                     'temp_store': 'MEMORY',
+                     'cache_size': -262144}  # negative values are KiB, ie 256 MB
+
+# Overrides of BULK_LOAD_PRAGMAS for loads that change tables already in the database (appends and syncs), and loads
+# that are meant to survive being interrupted (see the checkpoint option of gpd_to_spatialite). A crash mid transaction
+# with an in memory journal and no syncing can corrupt the whole database, not just the table being written,
+# so these loads keep a rollback journal on disk, and sync it at the critical moments.
+DURABLE_LOAD_PRAGMAS = {'synchronous': 'NORMAL',
+                        'journal_mode': 'TRUNCATE'}
+
+
+@contextmanager
+def bulk_load_pragmas(con, pragmas = None):
+    '''
+    Context manager that sets load friendly PRAGMAs on a connection, and restores the previous values on exit.
+    The open transaction is committed if the block completes, and rolled back if anything is raised inside it
+    (including KeyboardInterrupt and SystemExit), so an interrupted load never commits part of a transaction.
+
+    :param: con, a connection to a spatialite database
+    :param: pragmas, optional dict of PRAGMA name: value pairs to override/extend BULK_LOAD_PRAGMAS
+    '''
+    settings = dict(BULK_LOAD_PRAGMAS)
+    settings.update(pragmas or {})
+    cur = con.cursor()
+    # journal_mode can't be changed inside a transaction
+    con.commit()
+    previous = {}
+    for name, value in settings.items():
+        previous[name] = cur.execute('PRAGMA ' + name).fetchone()[0]
+        cur.execute('PRAGMA {} = {}'.format(name, value))
+    try:
+        yield
+    except BaseException:
+        con.rollback()
+        raise
+    else:
+        con.commit()
+    finally:
+        for name, value in previous.items():
+            cur.execute('PRAGMA {} = {}'.format(name, value))
+        cur.close()
+
+
+def _native(val):
+    '''
+    Convert a single value into something sqlite3 can bind natively.
+    Only used for object columns, where the values can be anything.
+    '''
+    if val is None or isinstance(val, (str, int, float, bytes)):
+        return val
+    elif isinstance(val, np.generic):
+        return val.item()
+    elif 'shapely' in str(type(val)):
+        return val.wkt
+    else:
+        return str(val)
+
+
+def _sql_values(series):
+    '''
+    Convert a pandas Series into a list of python values ready to bind as SQL parameters.
+    Numbers stay as native ints and floats, missing values of any kind become None (ie NULL),
+    and datetimes become ISO formatted strings, keeping any fractional seconds and time zone.
+    Nothing is converted to str unless it has to be.
+    '''
+    missing = series.isna().to_numpy()
+    if series.dtype.kind == 'M':
+        values = np.array([str(val) for val in series.array], dtype = object)
+    else:
+        values = series.to_numpy(dtype = object)
+    if missing.any():
+        # A new array, as to_numpy() can hand back a read only view of the data
+        values = np.where(missing, None, values)
+    if series.dtype.kind == 'O':
+        return [_native(val) for val in values]
+    return values.tolist()
+
+
+# The table recording the pandas dtype and storage encoding of every column written by gpd_to_spatialite,
+# so that spatialite_to_gdb can give back the same dtypes (named in db_utils, so listTables can leave it out)
+DTYPES_TABLE = PANDAS_DTYPES_TABLE
+
+# Nanoseconds per epoch unit, coarsest first
+_EPOCH_UNITS = {'s': 10 ** 9, 'ms': 10 ** 6, 'us': 10 ** 3, 'ns': 1}
+
+# The smallest 64 bit integer, which is also how NumPy holds NaT. Written as an expression, as SQLite
+# would read the literal -9223372036854775808 as the negation of a number too big for an integer, ie a REAL
+_NULL_INT = '(-9223372036854775807 - 1)'
+
+
+def _dtype_unit(dtype):
+    '''
+    The unit of a datetime or timedelta dtype, eg 'ns', whether a NumPy dtype or a pandas time zone aware one
+    '''
+    return getattr(dtype, 'unit', None) or np.datetime_data(dtype)[0]
+
+
+def _column_spec(series):
+    '''
+    Work out how a column is stored:
+        booleans as 0/1 INTEGERs
+        integers (including the nullable Int types) and floats as native INTEGERs and REALs
+        datetimes (with or without a time zone) and timedeltas as INTEGER counts of their dtype's unit (eg 'ns')
+        since 1970-01-01 UTC, so they are compact and range queries compare numbers
+        categoricals as INTEGER codes into a lookup table of the categories
+        anything else as TEXT
+
+    :return:
+    A tuple of (SQLite column type, encoding)
+    '''
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        return 'INTEGER', 'category_ordered' if dtype.ordered else 'category'
+    elif dtype.kind == 'b':
+        return 'INTEGER', 'bool'
+    elif dtype.kind in 'iu':
+        return 'INTEGER', 'native'
+    elif dtype.kind == 'f':
+        return 'REAL', 'native'
+    elif dtype.kind == 'M':
+        return 'INTEGER', 'datetime:' + _dtype_unit(dtype)
+    elif dtype.kind == 'm':
+        return 'INTEGER', 'timedelta:' + _dtype_unit(dtype)
+    return 'TEXT', 'text'
+
+
+def _legacy_encoding(series):
+    '''
+    The encoding for a column of a table written before the dtypes were recorded, where datetimes,
+    timedeltas and categories were all stored as text
+    '''
+    if series.dtype.kind in 'mM' or isinstance(series.dtype, pd.CategoricalDtype):
+        return 'text'
+    return _column_spec(series)[1]
+
+
+def _encode_values(series, encoding):
+    '''
+    Convert a pandas Series into a list of python values ready to bind as SQL parameters, in the given encoding
+    (see _column_spec()). Categoricals are not handled here, as their codes depend on the lookup table.
+    '''
+    missing = series.isna().to_numpy()
+    if encoding == 'bool':
+        values = series.to_numpy(dtype = bool, na_value = False).astype(np.int64)
+    elif encoding.startswith(('datetime:', 'timedelta:')):
+        unit_ns = _EPOCH_UNITS[_dtype_unit(series.dtype)]
+        ns = _EPOCH_UNITS[encoding.split(':')[1]]
+        values = series.array.asi8
+        if ns <= unit_ns:
+            values = values * (unit_ns // ns)
+        else:
+            if (values[~missing] % (ns // unit_ns)).any():
+                raise Exception('Column {} has values more precise than the {} it is stored in'.format(
+                    series.name, encoding.split(':')[1]))
+            values = values // (ns // unit_ns)
+    else:
+        return _sql_values(series)
+    if missing.any():
+        return np.where(missing, None, values.astype(object)).tolist()
+    return values.tolist()
+
+
+def _write_dtypes(cur, table, specs):
+    '''
+    Record the (pandas dtype, encoding) of each column of a table in the DTYPES_TABLE
+    '''
+    cur.execute('CREATE TABLE IF NOT EXISTS ' + DTYPES_TABLE + ' (table_name TEXT NOT NULL, column_name TEXT NOT NULL, '
+                'dtype TEXT, encoding TEXT, PRIMARY KEY (table_name, column_name))')
+    cur.executemany('INSERT OR REPLACE INTO ' + DTYPES_TABLE + ' (table_name, column_name, dtype, encoding) VALUES (?, ?, ?, ?)',
+                    [(table, col, dtype, encoding) for col, (dtype, encoding) in specs.items()])
+
+
+def _read_dtypes(con, table):
+    '''
+    The recorded (pandas dtype, encoding) of each column of a table, as a dict by column name.
+    Empty if the table was written before the dtypes were recorded, or by something else.
+    '''
+    try:
+        rows = con.cursor().execute('SELECT column_name, dtype, encoding FROM ' + DTYPES_TABLE + ' WHERE table_name = ?',
+                                    (table,)).fetchall()
+    except sqlite3.OperationalError:
+        return {}
+    return {col: (dtype, encoding) for col, dtype, encoding in rows}
+
+
+def _read_checkpoint(con, checkpoint, table):
+    '''
+    The recorded progress of a checkpointed load of a table, as a tuple of (chunks, rows) committed, or (0, 0) if there is none
+    '''
+    try:
+        row = con.cursor().execute('SELECT chunks, rows FROM ' + LOAD_CHECKPOINTS_TABLE + ' WHERE checkpoint = ? AND table_name = ?',
+                                   (checkpoint, table)).fetchone()
+    except sqlite3.OperationalError:
+        return 0, 0
+    return tuple(row) if row is not None else (0, 0)
+
+
+def _category_table(table, col):
+    '''
+    The name of the lookup table of the categories of a categorical column
+    '''
+    return table + '_' + col + '_categories'
+
+
+def _restore_dtype(series, dtype, encoding, categories = None):
+    '''
+    Turn a column as read from the database back into the pandas dtype it was written from.
+    Integer encoded datetimes, timedeltas and nullable integers are expected to be read with NULL as _NULL_INT,
+    so they come back as exact int64s rather than as floats.
+
+    :param: series, the column as read
+    :param: dtype, encoding, the recorded pandas dtype and encoding of the column
+    :param: categories, for categorical columns, the list of categories in code order
+    '''
+    if encoding.startswith('category'):
+        codes = series.fillna(-1).to_numpy(dtype = np.int64)
+        return pd.Series(pd.Categorical.from_codes(codes, categories, ordered = encoding == 'category_ordered'),
+                         index = series.index, name = series.name)
+    elif encoding.startswith(('datetime:', 'timedelta:')):
+        kind, unit = encoding.split(':')
+        values = series.to_numpy(dtype = np.int64).astype(('M8[' if kind == 'datetime' else 'm8[') + unit + ']')
+        restored = pd.Series(values, index = series.index, name = series.name)
+        target = pd.api.types.pandas_dtype(dtype)
+        if getattr(target, 'tz', None) is not None:
+            restored = restored.dt.tz_localize('UTC')
+        return restored.astype(target)
+    elif encoding == 'native' and dtype[:1] in ('I', 'U'):
+        # Nullable integers
+        values = series.to_numpy(dtype = np.int64)
+        missing = values == np.iinfo(np.int64).min
+        return pd.Series(pd.array(np.where(missing, 0, values), dtype = dtype), index = series.index,
+                         name = series.name).mask(missing)
+    elif encoding == 'bool' and series.isna().any():
+        return series.astype('boolean')
+    elif str(series.dtype) == dtype or (encoding == 'text' and dtype in ('object', 'str')):
+        # Plain strings come back as whatever the installed pandas uses for them by default
+        return series
+    try:
+        target = pd.api.types.pandas_dtype(dtype)
+    except TypeError:
+        # A dtype this version of pandas doesn't know, so leave the column as read
+        return series
+    if target.kind in 'iub' and series.isna().any():
+        # Numpy integers and booleans can't hold the NULLs, eg from rows added by something else
+        return series
+    return series.astype(target)
+
+
+def _insert_batches(cur, insert_sql, rows, batch_size):
+    '''
+    Send an iterable of parameter tuples to the database with executemany, batch_size rows at a time.
+    Does not commit, so that the caller controls the transaction.
+
+    :return:
+    The number of rows inserted
+    '''
+    rows = iter(rows)
+    nrows = 0
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        cur.executemany(insert_sql, batch)
+        nrows += len(batch)
+    return nrows
+
+
+def _geometry_to_wkb(geoms):
+    '''
+    Encode a GeoSeries (or any sequence of shapely geometries) as a list of WKB bytes, with None for missing geometries.
+    Uses the vectorized shapely 2 encoder where available, otherwise falls back to encoding one geometry at a time.
+    '''
+    if hasattr(shapely, 'to_wkb'):
+        return shapely.to_wkb(np.asarray(geoms, dtype = object)).tolist()
+    return [None if geom is None else geom.wkb for geom in geoms]
+
+
+# The geometries being encoded by the worker processes of _geometry_to_wkb_batches.
+# The workers are forked, so they inherit this rather than having the geometries pickled across to them
+# (pickling a shapely geometry encodes it as WKB anyway, which would do the work in this process).
+_WKB_SOURCE = None
+
+
+def _encode_wkb_slice(bounds):
+    '''
+    Worker process side of _geometry_to_wkb_batches: encode one (start, stop) slice of _WKB_SOURCE
+    '''
+    start, stop = bounds
+    return _geometry_to_wkb(_WKB_SOURCE[start:stop])
+
+
+def _geometry_to_wkb_batches(geoms, batch_size, workers = 1):
+    '''
+    Encode geometries to WKB in partitions of batch_size, yielding the lists of WKB in order.
+    
+    With more than one worker the partitions are encoded on a pool of forked processes, a few partitions ahead of
+    the consumer, so the encoding uses several cores while the single writer connection inserts the batches as they
+    arrive. Forking is only done on Linux: it isn't available on Windows, and isn't safe on macOS (where Python has
+    defaulted to spawn since 3.8). Elsewhere the partitions are encoded in this process instead, as sending the geometries
+    to spawned processes would cost as much as encoding them.
+    
+    :param: geoms, a GeoSeries (or sequence of shapely geometries)
+    :param: batch_size, the number of geometries per partition
+    :param: workers, the number of worker processes, None for the number of CPUs
+    '''
+    global _WKB_SOURCE
+    geoms = np.asarray(geoms, dtype = object)
+    bounds = [(start, min(start + batch_size, len(geoms))) for start in range(0, len(geoms), batch_size)]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(bounds) < 2 or not sys.platform.startswith('linux'):
+        for start, stop in bounds:
+            yield _geometry_to_wkb(geoms[start:stop])
+        return
+    _WKB_SOURCE = geoms
+    try:
+        with ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context('fork')) as pool:
+            # Keep a bounded number of partitions in flight, so the memory use doesn't grow with the table
+            remaining = iter(bounds)
+            pending = deque(pool.submit(_encode_wkb_slice, b) for b in itertools.islice(remaining, 2 * workers))
+            while pending:
+                batch = pending.popleft().result()
+                nxt = next(remaining, None)
+                if nxt is not None:
+                    pending.append(pool.submit(_encode_wkb_slice, nxt))
+                yield batch
+    finally:
+        _WKB_SOURCE = None
+
+
+def _timed_batches(batches, metrics):
+    '''
+    Pass on the WKB batches from _geometry_to_wkb_batches, adding the time spent waiting for each one,
+    and its number of geometries and bytes, to metrics
+    '''
+    batches = iter(batches)
+    while True:
+        start = time.perf_counter()
+        batch = next(batches, None)
+        metrics.seconds += time.perf_counter() - start
+        if batch is None:
+            return
+        metrics.add(rows = len(batch), bytes = sum(len(wkb) for wkb in batch if wkb is not None))
+        yield batch
+
+
+def _crs_to_epsg(crs):
+    '''
+    Get the EPSG code of a GeoDataFrame CRS, either a pyproj CRS (newer geopandas) or an {'init': 'epsg:XXXX'} dict.
+
+    :return:
+    The EPSG code, or None if there isn't one
+    '''
+    if hasattr(crs, 'to_epsg'):
+        return crs.to_epsg()
+    try:
+        return crs['init'].split(':')[1]
+    except (KeyError, TypeError):
+        return None
+
+
+def build_indexes(con, tablename, indexes = None, spatial_index = True, analyze = False):
+    '''
+    Build the indexes on a table, meant to be run after a bulk load so each index is built once in bulk,
+    rather than updated as every row goes in. Indexes that already exist are left alone.
+    
+    :param: con, a connection to a spatialite database
+    :param: tablename, the table to index
+    :param: indexes, optional list of attribute indexes to build, each a column name or a tuple of column names
+            for a composite index. An index on just the INTEGER PRIMARY KEY is skipped, as it would duplicate the rowid
+    :param: spatial_index, build the spatialite R*Tree spatial index on the geometry column, if the table has one
+    :param: analyze, gather the query planner statistics (ANALYZE) and the spatialite layer statistics (UpdateLayerStatistics)
+    
+    :return:
+    None
+    '''
+    cur = con.cursor()
+    with stage('index', con, table = tablename) as metrics:
+        size = database_bytes(cur)
+        pk_cols = [row[1] for row in cur.execute("pragma table_info('{}')".format(tablename)).fetchall() if row[5]]
+        for index in indexes or []:
+            cols = [index] if isinstance(index, str) else list(index)
+            if cols == pk_cols:
+                logger.info('Skipping index on %s(%s), the primary key is already indexed', tablename, cols[0])
+                continue
+            make_index_string = ('CREATE INDEX IF NOT EXISTS ' + tablename + '_' + '_'.join(cols) + '_idx ON ' +
+                                 tablename + '(' + ', '.join(cols) + ')')
+            logger.debug(make_index_string)
+            cur.execute(make_index_string)
+            metrics.add(statements = 1)
+        geom_col, srid, has_index = _geometry_column(con, tablename)
+        if spatial_index and geom_col is not None and not has_index:
+            makespatialindex = 'SELECT CreateSpatialIndex("' + tablename + '","' + geom_col + '")'
+            logger.debug(makespatialindex)
+            cur.execute(makespatialindex)
+            metrics.add(statements = 1)
+        con.commit()
+        if analyze:
+            logger.debug('ANALYZE ' + tablename)
+            cur.execute('ANALYZE ' + tablename)
+            metrics.add(statements = 1)
+            if geom_col is not None:
+                cur.execute('SELECT UpdateLayerStatistics("' + tablename + '","' + geom_col + '")')
+                metrics.add(statements = 1)
+            con.commit()
+        metrics.add(bytes = database_bytes(cur) - size)
+    cur.close()
+
+
+def gpd_to_spatialite(df, con, tablename, epsg = None, batch_size = 10000, pragmas = None, if_exists = 'fail', checkpoint = None, workers = 1,
+                      indexes = None, spatial_index = True, analyze = False):
     '''
     This function takes a dataframe or geodataframe, a connection object to a spatialite database, and a name for the new table (as a string),
     and creates a new table in database with the data of the dataframe.
     
     There are many small convenience functions contained within, some are more compliated string manipulation for creating the tables
     and inserting the values, others are very thing wrappers arouund single lines of SQL.
+
+    Rows are written in bulk: each column is converted to typed parameters once, and the rows are sent with executemany
+    in batches of batch_size, all inside a single transaction with the BULK_LOAD_PRAGMAS (plus any overrides in pragmas) set.
+    Appends and syncs to a table that already exists, and checkpointed loads, keep the DURABLE_LOAD_PRAGMAS on top of these,
+    so a crash can't corrupt the data already in the database.
+    For GeoDataFrames the geometries are sent as WKB alongside the attributes, so the table is written in a single pass.
+
+    Each column is stored in the most compact type that holds it exactly (see _column_spec()): numbers natively, booleans
+    as 0/1, datetimes and timedeltas as epoch integers and categoricals as codes into a lookup table. The pandas dtype and
+    encoding of each column are recorded in the DTYPES_TABLE, so spatialite_to_gdb gives back the same dtypes.
+    Tables written before the dtypes were recorded are appended to in their original, text based, encoding.
+
+    df can also be an iterator of (Geo)DataFrame chunks, eg from pd.read_csv(chunksize = ...) or a generator, so tables larger
+    than memory can be loaded. The first chunk defines the table schema, and every chunk is appended and committed in turn.
+    The chunks must carry unique index values between them, as the index becomes the primary key.
+
+    :param: if_exists, 'fail' to raise if the table already exists, 'append' to add the rows to the existing table, or 'sync'
+            to make the existing table match the dataframe, keyed on the index/primary key: only new or changed rows are
+            written, and rows no longer in the dataframe are deleted, so the cost tracks the size of the change
+            (see syncTable). Needs a single (Geo)DataFrame, and SQLite 3.24 or later for the upserts
+    :param: checkpoint, optional name (eg the path of the source) under which the number of committed chunks is recorded,
+            in the LOAD_CHECKPOINTS_TABLE. Each chunk's progress is written in the same transaction as the chunk, so the record
+            can never disagree with the table. If a load is interrupted, calling again with the same checkpoint and an identical
+            chunk stream skips the chunks already loaded. The record is removed once the load completes.
+            As the load has to survive being interrupted, it runs with the DURABLE_LOAD_PRAGMAS rather than the in memory journal
+    :param: workers, the number of processes used to encode geometries as WKB, None for the number of CPUs.
+            The writes still all go through con, in order, in the same transaction
+    :param: indexes, spatial_index, analyze, the indexes to build once the data is loaded, see build_indexes().
+            No separate index is made on the primary key, as the INTEGER PRIMARY KEY already is the rowid
+
+    Progress is logged rather than printed, with the SQL at DEBUG level, and the load is measured in stages
+    (create, populate, geometry, commit, index and the whole load), see the instrumentation module.
+    The bytes of the populate and index stages are the growth of the database file.
     '''
     
-    def isna(obj):
-        if isinstance(obj, float):
-            return np.isnan(obj)
-        else:
-            return False
-    
     def createTable(df, tablename, columns = 'all'):
         '''
-        Create a new SQLite table with the correct datatypes to reflect all the existing data in the dataframe.
+        Create a new SQLite table with the column type to suit each column of the dataframe (see _column_spec()),
+        and record the pandas dtype and encoding of each column so that spatialite_to_gdb can restore them.
         This is designed to work for non-geometry columns, but this is assumed, rather than explict in this function.
         The construction of the columns variable for the function calls (when called below), explictly exclude geometry
         '''
         if columns == 'all':
             columns = df.columns
-        # Lookup of pandas dtypes to SQLite dtypes
-        dtype_mapping = {'int' : 'INTEGER', 'float': 'REAL', 'object':'TEXT', 'date':'DATETIME'}
         #start of the table creation string
         s = df.index.name + ' INTEGER PRIMARY KEY NOT NULL'
-        # Loop through all the columns in the dataframe, ignore if not in the specified list, and find its SQLite dtype
-        for col, dtype in df.dtypes.iteritems():
-            if col not in columns:
-                continue
-            for key, value in dtype_mapping.items():
-                if key in str(dtype):
-                    dbdtype = value
-                    break
-            # Add the column name and the SQL dtype to the string
-            s += ', ' + col + ' ' + dbdtype
+        # Find the SQLite type of each column, and add the column name and type to the string
+        for col in columns:
+            s += ', ' + col + ' ' + _column_spec(df[col])[0]
         # Prepend the SQL keywords to the string
         maketable_string = 'CREATE TABLE ' + tablename + '(' + s + ')'
-        print(maketable_string)
+        logger.debug(maketable_string)
         cur.execute(maketable_string)
+        # Forget anything recorded about an earlier table of the same name
+        if _read_dtypes(con, tablename):
+            cur.execute('DELETE FROM ' + DTYPES_TABLE + ' WHERE table_name = ?', (tablename,))
+        recordSpecs(df, tablename, columns)
         con.commit()
-        
-    def createIndex(df, tablename):
-        make_pk_index_string = 'CREATE INDEX ' + tablename + '_' + df.index.name + '_idx ON ' + tablename + '(' + df.index.name + ')'
-        print(make_pk_index_string)
-        cur.execute(make_pk_index_string)  
-        con.commit()
 
-    def populateTable(df, tablename, columns = 'all'):
+    def recordSpecs(df, tablename, columns):
+        '''
+        Work out, and record, the dtype and encoding of columns that are new to the table.
+        Categorical columns also get a lookup table of their categories (see _category_table()), where the position
+        of each category is its code, so the codes stay the same whichever chunk or load adds the category.
+        '''
+        new_specs = {col: (str(df[col].dtype), _column_spec(df[col])[1]) for col in columns}
+        _write_dtypes(cur, tablename, new_specs)
+        for col, (dtype, encoding) in new_specs.items():
+            if encoding.startswith('category'):
+                lookup = _category_table(tablename, col)
+                cur.execute('DROP TABLE IF EXISTS ' + lookup)
+                cur.execute('CREATE TABLE ' + lookup + ' (code INTEGER PRIMARY KEY NOT NULL, value)')
+        specs.update(new_specs)
+
+    def columnSpecs(df, tablename, columns):
+        '''
+        The (dtype, encoding) of each column being written to an existing table. Columns the table has no record of
+        are recorded now if the table records its dtypes (eg columns added with ALTER TABLE), otherwise they are
+        written the way they were before dtypes were recorded, to match what is already in the table.
+        '''
+        missing = [col for col in columns if col not in specs]
+        if missing:
+            if specs:
+                recordSpecs(df, tablename, missing)
+            else:
+                return {col: (str(df[col].dtype), _legacy_encoding(df[col])) for col in columns}
+        widenUnits(df, tablename, columns)
+        return specs
+
+    def widenUnits(df, tablename, columns):
+        '''
+        Move datetime and timedelta columns stored in a coarser unit than the dataframe's dtype (eg a table written
+        from datetime64[s], appended to from datetime64[ns]) to the finer unit, by rescaling the stored integers,
+        so the new values are stored exactly.
+        '''
+        widened = {}
+        for col in columns:
+            dtype, encoding = specs[col]
+            if not encoding.startswith(('datetime:', 'timedelta:')) or df[col].dtype.kind not in 'mM':
+                continue
+            kind, unit = encoding.split(':')
+            new_unit = _dtype_unit(df[col].dtype)
+            if _EPOCH_UNITS[new_unit] < _EPOCH_UNITS[unit]:
+                cur.execute('UPDATE ' + tablename + ' SET ' + col + ' = ' + col + ' * ?',
+                            (_EPOCH_UNITS[unit] // _EPOCH_UNITS[new_unit],))
+                widened[col] = (str(df[col].dtype), kind + ':' + new_unit)
+        if widened:
+            logger.info('Widened the units of {} in {}'.format(', '.join(widened), tablename))
+            _write_dtypes(cur, tablename, widened)
+            specs.update(widened)
+
+    def categoryCodes(series, tablename, col):
+        '''
+        The codes of a categorical column in the lookup table of its categories, adding any categories new to the table
+        '''
+        lookup = _category_table(tablename, col)
+        known = {value: code for code, value in cur.execute('SELECT code, value FROM ' + lookup)}
+        categories = [_native(value) for value in series.cat.categories]
+        new = [value for value in categories if value not in known]
+        if new:
+            cur.executemany('INSERT INTO ' + lookup + ' (code, value) VALUES (?, ?)',
+                            [(len(known) + i, value) for i, value in enumerate(new)])
+            known.update({value: len(known) + i for i, value in enumerate(new)})
+        mapping = np.array([known[value] for value in categories] + [-1], dtype = np.int64)
+        codes = series.cat.codes.to_numpy()
+        # Missing values have code -1, which picks out the -1 on the end of the mapping
+        mapped = mapping[codes]
+        if (codes < 0).any():
+            return np.where(codes < 0, None, mapped.astype(object)).tolist()
+        return mapped.tolist()
+
+    def encodeColumn(df, tablename, col, encoding):
+        if encoding.startswith('category'):
+            return categoryCodes(df[col], tablename, col)
+        return _encode_values(df[col], encoding)
+        
+    def populateTable(df, tablename, columns = 'all', geom_col = None, upsert = False, wkb = None):
         '''
         This code populates a newly created table with the data from the corresponding dataframe.
-        Done as a loop, one row at a time.
-        If the value is a shapely geometry (ie geopandas geometry), save the values as the well known text shape format
+        Each column is converted to a list of SQL values in one go, in the encoding recorded for it (see _column_spec()),
+        ie native numbers, 0/1 for booleans, epoch integers for datetimes and codes for categoricals, and the rows are then
+        inserted with executemany in batches, in a single transaction.
+        If geom_col is given, the geometries are encoded once as WKB (in parallel, with more than one worker) and
+        inserted in the same statement as the attributes via GeomFromWKB, so each row is written in a single pass.
+        If upsert is set, rows whose primary key is already in the table are updated in place instead.
+        wkb can pass in the geometries already encoded (as a list of WKB), so they aren't encoded again.
         '''
-        print('Inserting rows into %s' %(tablename))
         # Define columns if not passed explictly
         if columns == 'all':
             columns = df.columns
-        # Do some funky string manip to get it SQL ready
-        cols = df.index.name + ', ' + str(list(columns)).replace('[','').replace(']','').replace("'",'')
-        # Loop through all the columns for each row, testing the inputs.
-        # If it's not a string, turn it into one, if it is, wrap it in quotes
-        # Add the result onto the string for execution.
-        for i, row in df[columns].iterrows():
-            vals = [str(i)]
-            ncols = len(columns) + 1
-            for col, val in row.iteritems():
-                if isinstance(val, str):
-                    vals.append(val) # needs quotes around it?
-                elif isna(val):
-                    vals.append('NULL')
-                elif val is None:
-                    vals.append('NULL')
-                elif 'shapely' in str(type(val)):
-                    vals.append(val.wkt)
-                else:
-                    vals.append(str(val))
-            qmarks = str([',?' if i > 0 else '?' for i in range(ncols)])[1:-1].replace("'",'').replace(', ','')
-            s = 'INSERT INTO ' + tablename + ' (' + cols + ') VALUES (' + qmarks + ')'
-            # print(s, vals)
-            cur.execute(s, vals)
-            
-        con.commit()
+        columns = list(columns)
+        qmarks = ['?'] * (len(columns) + 1)
+        # Build the parameters column by column, then zip them back up into rows
+        col_specs = columnSpecs(df, tablename, columns)
+        values = [_sql_values(df.index.to_series())] + [encodeColumn(df, tablename, col, col_specs[col][1]) for col in columns]
+        geometry_metrics = None
+        if geom_col is not None:
+            columns = columns + [geom_col]
+            qmarks.append('GeomFromWKB(?, ' + str(epsg) + ')')
+            if wkb is not None:
+                values.append(wkb)
+            else:
+                # The encoding is interleaved with the inserts, so its time is measured as it happens, within the populate stage
+                geometry_metrics = StageMetrics('geometry', table = tablename, workers = workers)
+                batches = _timed_batches(_geometry_to_wkb_batches(df[geom_col], batch_size, workers), geometry_metrics)
+                values.append(itertools.chain.from_iterable(batches))
+        cols = ', '.join([df.index.name] + columns)
+        s = 'INSERT INTO ' + tablename + ' (' + cols + ') VALUES (' + ', '.join(qmarks) + ')'
+        if upsert:
+            s += (' ON CONFLICT(' + df.index.name + ') DO UPDATE SET ' +
+                  ', '.join(col + ' = excluded.' + col for col in columns))
+        logger.debug(s)
+        with stage('populate', con, table = tablename) as metrics:
+            size = database_bytes(cur)
+            nrows = _insert_batches(cur, s, zip(*values), batch_size)
+            metrics.add(rows = nrows, statements = -(-nrows // batch_size), bytes = database_bytes(cur) - size)
+        if geometry_metrics is not None:
+            emit(geometry_metrics)
+        with stage('commit', con, table = tablename):
+            con.commit()
 
     def makeGeomColumn(df, tablename, geom_col):
         '''
         Makes a geometry column based on the type of geometry and CRS within the dataframe.
+        If the dataframe holds more than one type of geometry, a generic GEOMETRY column is made.
         '''
-        geomtype = df.iloc[0]['temp_geom'].wkt.split(' ')[0].strip()
-        crs = df.crs['init'].split(':')[1]
-        makegeomcol_string = 'SELECT AddGeometryColumn("' + tablename + '","' + geom_col + '",' + str(crs) + ',"' + geomtype + '","XY");'
-        print(makegeomcol_string)
+        geomtypes = df[geom_col].geom_type.dropna().str.upper().unique()
+        geomtype = geomtypes[0] if len(geomtypes) == 1 else 'GEOMETRY'
+        dims = 'XYZ' if df[geom_col].has_z.any() else 'XY'
+        makegeomcol_string = 'SELECT AddGeometryColumn("' + tablename + '","' + geom_col + '",' + str(epsg) + ',"' + geomtype + '","' + dims + '");'
+        logger.debug(makegeomcol_string)
         cur.execute(makegeomcol_string)       
         con.commit()
     
-    def createGeometries(df, tablename, geom_col):
+    def prepareChunk(df):
         '''
-        Creates the actual geometries from the temp_geom columns WKT format geometries
+        Test if the geodataframe or a normal dataframe.
+        If its a geodataframe, check the geometry and CRS are valid
+        If so, return the name of the geometry column so it can be kept out of the attribute columns.
         '''
-        crs = df.crs['init'].split(':')[1]
-        makeshapes = 'UPDATE ' + tablename + ' SET ' + geom_col + '=GeomFromText(temp_geom,' + crs + ')'
-        print(makeshapes)
-        cur.execute(makeshapes)
-        con.commit()
-        
-    def insertColumnInOtherTable(existing_table, table_tochange, column_name):
+        nonlocal epsg
+        if isinstance(df, gpd.GeoDataFrame):
+            # save this name for use later on
+            geom_col = df.geometry.name
+            if not isinstance(df[geom_col], gpd.GeoSeries):
+                raise Exception('GeoDataFrame geometry column is not setup correctly')
+            elif df.crs is None:
+                raise Exception('GeoDataFrame coordinate reference system is not setup correctly')
+            # An epsg passed in overrides the CRS of the dataframe
+            if epsg is None:
+                epsg = _crs_to_epsg(df.crs)
+            if epsg is None:
+                raise Exception('The CRS are present, but no EPSG code is defined. Please establish correct EPSG and pass to function')
+        elif isinstance(df, pd.DataFrame):
+            geom_col = None
+        else:
+            raise Exception('Please pass a valid pandas Dataframe or a valid Geopandas GeoDataFrame as the first argument')        
+        # Name the df.index if it isn't already named
+        if df.index.name is None:
+            logger.info('DataFrame index/primary key renamed to "OID"')
+            df.index.name = "OID"
+        return geom_col
+
+    def rowHashes(df, tablename, columns, geom_col):
         '''
-        Copies the values from one column into another table.
-        Assumes the destination table column already exists and is identically named.
+        A 64 bit hash of the content of each row (attributes and geometry WKB), as a Series indexed by primary key
+
+        :return:
+        A tuple of (hashes, WKB), where the WKB is the Series of encoded geometries (None without a geom_col),
+        kept so the changed rows can be written without encoding their geometries again
         '''
-        new_col_string = 'UPDATE ' + table_tochange + ' SET ' + column_name + ' =  (SELECT ' + column_name + ' FROM ' + existing_table + ')'
-        print(new_col_string)
-        cur.execute(new_col_string)
-        con.commit()
-        
-    def makeSpatialIndex(tablename, geom_col):
+        frame = df[columns].copy()
+        wkb = None
+        if geom_col is not None:
+            geometry_metrics = StageMetrics('geometry', table = tablename, workers = workers)
+            batches = _timed_batches(_geometry_to_wkb_batches(df[geom_col], batch_size, workers), geometry_metrics)
+            wkb = pd.Series(list(itertools.chain.from_iterable(batches)), index = df.index, dtype = object)
+            emit(geometry_metrics)
+            frame[geom_col] = wkb
+        hashes = pd.util.hash_pandas_object(frame, index = False).to_numpy()
+        # SQLite integers are signed
+        return pd.Series(hashes.view(np.int64), index = df.index), wkb
+
+    def syncTable(df, tablename, columns, geom_col):
         '''
-        Creates a spatial index on a table with spatial geometries.
+        Bring an existing table into line with the dataframe, keyed on the primary key, touching only the rows that differ.
+        The content hash of every row is kept in a side table (<tablename>_rowhash). Rows with a new key or a different
+        hash are upserted, rows of the table whose key is no longer in the dataframe are deleted, and all of it is one transaction.
+        Rows without a hash (eg all of them, the first time a table written with 'fail' or 'append' is synced) count as
+        changed, so they are rewritten once and their hashes seeded.
         '''
-        makespatialindex = 'SELECT CreateSpatialIndex("' + tablename + '","' + geom_col + '")'
-        print(makespatialindex)
-        cur.execute(makespatialindex)          
-        con.commit()
-    
-    def dropTable(tablename):
+        pk = df.index.name
+        hash_table = tablename + '_rowhash'
+        cur.execute('CREATE TABLE IF NOT EXISTS ' + hash_table + ' (' + pk + ' INTEGER PRIMARY KEY NOT NULL, rowhash INTEGER)')
+        old = pd.read_sql_query('SELECT ' + pk + ', rowhash FROM ' + hash_table, con, index_col = pk)['rowhash']
+        # The keys actually in the table, which the hashes may not cover
+        existing = pd.Index([row[0] for row in cur.execute('SELECT ' + pk + ' FROM ' + tablename)])
+        with stage('sync', con, table = tablename) as metrics:
+            new, wkb = rowHashes(df, tablename, columns, geom_col)
+            previous = old.reindex(new.index)
+            changed = new.index[previous.isna().to_numpy() | (previous.to_numpy() != new.to_numpy())]
+            gone = existing.union(old.index).difference(new.index)
+            logger.info('Syncing {}: {:,} new or changed rows, {:,} rows to delete, {:,} unchanged'.format(
+                tablename, len(changed), len(gone), len(new) - len(changed)))
+            # Nothing below commits until populateTable, so the deletes, hashes and upserts all land together
+            gone_keys = [(key,) for key in _sql_values(gone.to_series())]
+            cur.executemany('DELETE FROM ' + tablename + ' WHERE ' + pk + ' = ?', gone_keys)
+            cur.executemany('DELETE FROM ' + hash_table + ' WHERE ' + pk + ' = ?', gone_keys)
+            cur.executemany('INSERT INTO ' + hash_table + ' (' + pk + ', rowhash) VALUES (?, ?) '
+                            'ON CONFLICT(' + pk + ') DO UPDATE SET rowhash = excluded.rowhash',
+                            zip(_sql_values(changed.to_series()), new[changed].tolist()))
+            metrics.add(rows = len(new), statements = 3)
+        populateTable(df.loc[changed], tablename, columns, geom_col, upsert = True,
+                      wkb = wkb[changed].tolist() if wkb is not None else None)
+
+    def saveCheckpoint(nchunks, nrows):
         '''
-        Drop a table from the database
+        Record how many chunks will have been loaded once the current transaction commits, so an interrupted load
+        can pick up where it left off. Called before the chunk is committed, so the record goes in with it, or not at all.
         '''
-        drop_temp_table_string = 'DROP TABLE ' + tablename
-        print(drop_temp_table_string)
-        cur.execute(drop_temp_table_string)
-    
-    def updateTable(df, tablename, columns):
-        '''
-        Adds the data from the dataframe to the table name. Only operates on the columns specificed
-        '''
-        print('Updating %s in %s' %(columns, tablename))
-        for rownum, row in df.iterrows():
-            update_string = ''
-            vals = []
-            for col in columns:
-                val = row[col]
-                if isinstance(val, str):
-                    vals.append(val)
-                elif isna(val):
-                    vals.append('NULL')
-                elif val is None:
-                    vals.append('NULL')
-                else:
-                    vals.append(str(val))
-                if update_string == '':
-                    update_string = 'UPDATE ' + tablename + ' SET ' + col + ' = ?'
-                else:
-                    update_string += ', ' + col + ' =  ?'
-
-            update_string += ' WHERE ' + df.index.name + ' = ' + str(rownum)
-            # print(update_string)
-            cur.execute(update_string, vals)
-            
-    def intraSQLinsert(src_table, dst_table, columns):
-        cols = str(columns).replace('[','').replace(']','').replace("'",'')
-        insert_string = 'INSERT INTO '+ dst_table + ' (' + cols + ') SELECT ' + cols + ' FROM ' + src_table
-        print(insert_string)
-        cur.execute(insert_string)
-
-    # Test if the geodataframe or a normal dataframe.
-    # If its a geodataframe, check the geometry and CRS are valid
-    # If so, move the geometry to a temp column and save the name for future reassignment.
-    if isinstance(df, gpd.GeoDataFrame):
-        # save this name for use later on
-        geom_col = df.geometry.name
-        if not isinstance(df[geom_col], gpd.GeoSeries):
-            raise Exception('GeoDataFrame geometry column is not setup correctly')
-        elif df.crs is None:
-            raise Exception('GeoDataFrame coordinate reference system is not setup correctly')
-        else:
-            isSpatial = True
-            df = df.rename(columns = {geom_col:'temp_geom'}).set_geometry('temp_geom')
-        if epsg is not None:
-            df.crs['init'] = 'epsg:' + str(epsg)
-        try: 
-            epsg = df.crs['init'].split(':')[1]
-        except KeyError:
-            raise Exception('The CRS are present, but no EPSG code is defined. Please establish correct EPSG and pass to function')
-    elif isinstance(df, pd.DataFrame):
-        isSpatial = False
-    else:
-        raise Exception('Please pass a valid pandas Dataframe or a valid Geopandas GeoDataFrame as the first argument')        
-        
+        cur.execute('CREATE TABLE IF NOT EXISTS ' + LOAD_CHECKPOINTS_TABLE + ' (checkpoint TEXT NOT NULL, '
+                    'table_name TEXT NOT NULL, chunks INTEGER, rows INTEGER, PRIMARY KEY (checkpoint, table_name))')
+        cur.execute('INSERT OR REPLACE INTO ' + LOAD_CHECKPOINTS_TABLE + ' (checkpoint, table_name, chunks, rows) '
+                    'VALUES (?, ?, ?, ?)', (checkpoint, tablename, nchunks, nrows))
+
+    if if_exists not in ('fail', 'append', 'sync'):
+        raise Exception('if_exists must be one of "fail", "append" or "sync", not "{}"'.format(if_exists))
+    if if_exists == 'sync' and not isinstance(df, pd.DataFrame):
+        raise Exception('if_exists = "sync" needs the whole (Geo)DataFrame, to know which rows have gone')
+    # A single (Geo)DataFrame is treated as a stream of one chunk
+    chunks = [df] if isinstance(df, pd.DataFrame) else df
+
     # Create cursor object
     cur = con.cursor()
-    # Name the df.index if it isn't already named
-    if df.index.name is None:
-        print('DataFrame index/primary key renamed to "OID"')
-        df.index.name = "OID"
-    # Make the destination table, excluding any geometry columns
-    good_table_cols = [col for col in df.columns if col != 'temp_geom']
-    createTable(df, tablename, good_table_cols)
-    createIndex(df, tablename)
-    # If not spatial, populate the table completely now.
-    # Note: doing this before getting the final geometries into the table seemed to cause errors with the index when read in Arc.
-    if not isSpatial:
-        populateTable(df, tablename, good_table_cols)   
-
-    if isSpatial:
-        # Make a temporary table, with only the primary key and temp geom (ie well known text)
-        temp_table_name = tablename + "_temp"
-        temp_table_cols = ['temp_geom'] # the index/primary key is also done automatically
-        createTable(df,  temp_table_name, temp_table_cols)
-        populateTable(df, temp_table_name, temp_table_cols)
-        # Make a geomcolumn from temp table
-        makeGeomColumn(df, temp_table_name, geom_col)
-        # Populate geometry column in temp table
-        createGeometries(df, temp_table_name, geom_col)
-        # Make a geom column in actual table
-        makeGeomColumn(df, tablename, geom_col)
-        # Populate actual table geometry and primary key from temp table geometry
-        intraSQLinsert(temp_table_name, tablename, ['OID','geometry'])
-#         cur.execute('INSERT INTO test(OID, geometry) SELECT OID, geometry from test_temp')
-        # Now add all the non-spatial data into the table
-        updateTable(df, tablename, good_table_cols)
-        # drop temp table
-        dropTable(temp_table_name)
-        # make SpatialIndex
-        # makeSpatialIndex(tablename, geom_col)   
-    con.commit()
+    table_exists = cur.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (tablename,)).fetchone()[0] > 0
+    # Pick up from the checkpoint of a previous, interrupted load of this table
+    done_chunks, done_rows = 0, 0
+    if checkpoint is not None and table_exists:
+        done_chunks, done_rows = _read_checkpoint(con, checkpoint, tablename)
+        if done_chunks:
+            logger.info('Resuming load of {} after {} chunks ({:,} rows)'.format(tablename, done_chunks, done_rows))
+    if table_exists and if_exists == 'fail' and done_chunks == 0:
+        raise Exception('Table {} already exists. Use if_exists = "append" to add to it'.format(tablename))
+    # The recorded (dtype, encoding) of each column, which every chunk is written in
+    specs = _read_dtypes(con, tablename) if table_exists else {}
+
+    # Everything from here on runs with the bulk load PRAGMAs set, kept durable when data already in the database is at stake
+    load_pragmas = dict(DURABLE_LOAD_PRAGMAS) if checkpoint is not None or table_exists else {}
+    load_pragmas.update(pragmas or {})
+    with bulk_load_pragmas(con, load_pragmas), stage('load', con, table = tablename) as load_metrics:
+        nrows = done_rows
+        for i, chunk in enumerate(chunks):
+            # Chunks already committed by an earlier run are read and thrown away
+            if i < done_chunks:
+                continue
+            geom_col = prepareChunk(chunk)
+            good_table_cols = [col for col in chunk.columns if col != geom_col]
+            # The first chunk written defines the schema
+            if not table_exists:
+                with stage('create', con, table = tablename) as metrics:
+                    # Make the destination table, excluding any geometry columns
+                    createTable(chunk, tablename, good_table_cols)
+                    metrics.add(statements = 1)
+                    if geom_col is not None:
+                        # Add the geometry column up front, so that attributes and geometry go in together in one pass
+                        makeGeomColumn(chunk, tablename, geom_col)
+                        metrics.add(statements = 1)
+                table_exists = True
+            nrows += len(chunk)
+            if checkpoint is not None:
+                saveCheckpoint(i + 1, nrows)
+            if if_exists == 'sync':
+                syncTable(chunk, tablename, good_table_cols, geom_col)
+            else:
+                populateTable(chunk, tablename, good_table_cols, geom_col)
+            load_metrics.add(rows = len(chunk))
+        # Build the indexes once all the data is in, rather than maintaining them row by row during the load
+        if table_exists:
+            build_indexes(con, tablename, indexes, spatial_index, analyze)
+        # The load completed, so there is nothing left to resume
+        if checkpoint is not None and _read_checkpoint(con, checkpoint, tablename)[0]:
+            cur.execute('DELETE FROM ' + LOAD_CHECKPOINTS_TABLE + ' WHERE checkpoint = ? AND table_name = ?',
+                        (checkpoint, tablename))
+        with stage('commit', con, table = tablename):
+            con.commit()
     cur.close()
 
-def spatialite_to_gdb(con, table):
-    query = 'select * from {}'.format(table)
-    df = pd.read_sql_query(query, con)
-    if 'geom' not in df.columns:
-        return df
-    else:
-        epsg = con.cursor().execute('select SRID(geom) from {}'.format(table))[0][0]
-        df = gpd.GeoDataFrame(df)
-        df.crs = {'init':'epsg:{}'.format(epsg)}
+def _geometry_column(con, table):
+    '''
+    Look up the registered geometry column of a table in the spatialite geometry_columns metadata.
+
+    :return:
+    A tuple of (geometry column name, srid, has spatial index), or (None, None, False) if the table isn't spatial
+    '''
+    try:
+        row = con.cursor().execute('SELECT f_geometry_column, srid, spatial_index_enabled FROM geometry_columns '
+                                   'WHERE lower(f_table_name) = lower(?)', (table,)).fetchone()
+    except sqlite3.OperationalError:
+        # Not a spatialite database, so there can't be any geometry
+        row = None
+    if row is None:
+        return None, None, False
+    return row[0], row[1], bool(row[2])
 
 
-# def spatialite_table_to_gdb(con, table):
-#
-#     return = spatialite_to gdb(con, query)
\ No newline at end of file
+def _decode_geometry(df, geom_col, srid):
+    '''
+    Turn a DataFrame with a WKB geometry column into a GeoDataFrame, decoding all the geometries in one go.
+    '''
+    # SpatiaLite uses an SRID of 0 or -1 for undefined
+    crs = 'EPSG:{}'.format(srid) if srid is not None and srid > 0 else None
+    geoms = gpd.GeoSeries.from_wkb(df[geom_col].values, index = df.index, crs = crs)
+    # The geometry keeps the name (and position) it has in the table, so reads round trip
+    return gpd.GeoDataFrame(df.assign(**{geom_col: geoms}), geometry = geom_col, crs = crs)
+
+
+def spatialite_to_gdb(con, table, columns = None, where = None, params = None, bbox = None, chunksize = None):
+    '''
+    Read a table from a spatialite database into a DataFrame, or a GeoDataFrame if the table has a registered geometry column.
+    Geometries are pulled out as WKB with AsBinary() and decoded to a GeoSeries in bulk. The primary key, if any, becomes the index.
+    Columns written by gpd_to_spatialite are given back their original pandas dtypes (categoricals, datetimes with their
+    time zones, booleans, nullable integers, ...) from the DTYPES_TABLE.
+    
+    :param: con, the connection to the spatialite database
+    :param: table, the name of the table to read
+    :param: columns, optional list of the columns to read. The geometry column (if any) is always included
+    :param: where, optional SQL condition to filter the rows, without the WHERE keyword, eg 'depth > ?'
+    :param: params, optional sequence of values for any ? placeholders in where
+    :param: bbox, optional (minx, miny, maxx, maxy) in the table CRS. Only rows whose geometry bounds intersect the bbox are read.
+            The spatialite R*Tree (via the SpatialIndex virtual table) is used to find candidates when the table has one
+    :param: chunksize, if given, a generator is returned that yields chunks of this many rows instead of the whole table
+    
+    :return:
+    A pandas DataFrame or geopandas GeoDataFrame, or a generator of them if chunksize is given
+    '''
+    geom_col, srid, has_index = _geometry_column(con, table)
+    table_info = con.cursor().execute("pragma table_info('{}')".format(table)).fetchall()
+    pk_cols = [row[1] for row in table_info if row[5]]
+    index_col = pk_cols[0] if len(pk_cols) == 1 else None
+    if columns is None:
+        columns = [row[1] for row in table_info]
+    # The primary key is always read, as the index, and the geometry is always read, as WKB
+    columns = [col for col in columns if col not in (index_col, geom_col)]
+    specs = _read_dtypes(con, table)
+    # Integer encoded columns that may hold NULLs are read with NULL as _NULL_INT, as pandas would otherwise turn
+    # the column into floats and lose the precision of large values (eg nanosecond datetimes)
+    select_cols = ([index_col] if index_col is not None else []) + [
+        'ifnull({0}, {1}) AS {0}'.format(col, _NULL_INT)
+        if col in specs and (specs[col][1].startswith(('datetime:', 'timedelta:')) or
+                             (specs[col][1] == 'native' and specs[col][0][:1] in ('I', 'U'))) else col
+        for col in columns]
+    categories = {col: [value for code, value in con.cursor().execute(
+                      'SELECT code, value FROM ' + _category_table(table, col) + ' ORDER BY code')]
+                  for col in columns if col in specs and specs[col][1].startswith('category')}
+    if geom_col is not None:
+        select_cols.append('AsBinary({0}) AS {0}'.format(geom_col))
+    query = 'SELECT ' + ', '.join(select_cols) + ' FROM ' + table
+
+    conditions = []
+    query_params = []
+    if bbox is not None:
+        if geom_col is None:
+            raise Exception('Table {} has no geometry column to filter by bbox'.format(table))
+        mbr = 'BuildMbr(?, ?, ?, ?, {})'.format(srid)
+        if has_index:
+            conditions.append('ROWID IN (SELECT ROWID FROM SpatialIndex WHERE f_table_name = ? '
+                              'AND f_geometry_column = ? AND search_frame = ' + mbr + ')')
+            query_params += [table, geom_col] + list(bbox)
+        # The R*Tree only narrows down the candidates, so the bounds are still tested exactly
+        conditions.append('MbrIntersects(' + geom_col + ', ' + mbr + ')')
+        query_params += list(bbox)
+    if where is not None:
+        conditions.append('(' + where + ')')
+        query_params += list(params or [])
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+
+    def toFrame(df):
+        if index_col is not None:
+            df = df.set_index(index_col)
+        for col in columns:
+            if col in specs:
+                df[col] = _restore_dtype(df[col], specs[col][0], specs[col][1], categories.get(col))
+        if geom_col is not None:
+            df = _decode_geometry(df, geom_col, srid)
+        return df
+
+    if chunksize is None:
+        return toFrame(pd.read_sql_query(query, con, params = query_params))
+    return (toFrame(chunk) for chunk in pd.read_sql_query(query, con, params = query_params, chunksize = chunksize))
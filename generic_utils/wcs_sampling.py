@@ -0,0 +1,251 @@
+'''
+Batched, cached sampling of elevations (or any single band coverage) from a Web Coverage Service, for many points at once.
+
+Rather than one GetCoverage request per borehole, the points are grouped into fixed tiles on the coverage grid.
+Each tile is fetched once as a GeoTIFF, with a bounded pool of threads fetching tiles concurrently, and kept in an
+on disk cache with a total size limit (least recently used tiles are evicted first). All the points in a tile are
+then sampled together with vectorized bilinear interpolation.
+
+eg:
+sampler = WCSSampler('http://services.ga.gov.au/gis/services/DEM_SRTM_1Second/MapServer/WCSServer', coverage = '1',
+                     resolution = 1 / 3600, cache_dir = 'wcs_cache')
+bh_header['elevation'] = sampler.sample(bh_header.geometry.x, bh_header.geometry.y)
+
+Only WCS 1.0.0 KVP GetCoverage requests are used, so anything that speaks that (including a local stand-in server
+for testing) can be used as the url.
+'''
+import hashlib
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+import numpy as np
+import tifffile
+
+logger = logging.getLogger(__name__)
+
+
+class TileCache(object):
+    '''
+    An on disk cache of fetched tiles, with a limit on the total size.
+    Each tile is a file named by the hash of its request. Reading a tile marks it as recently used (by touching its mtime),
+    and when the cache grows past max_bytes the least recently used tiles are removed.
+
+    :param: cache_dir, the directory to keep the tiles in. Created if it doesn't exist
+    :param: max_bytes, the maximum total size of the cached tiles
+    '''
+    def __init__(self, cache_dir, max_bytes = 1 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok = True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf8')).hexdigest() + '.tif')
+
+    def get(self, key):
+        '''
+        The cached bytes for a key, or None if it isn't cached
+        '''
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted (eg by another sampler sharing the cache) since it was read, which doesn't matter to this read
+            pass
+        return data
+
+    def put(self, key, data):
+        '''
+        Cache the bytes for a key, then evict the least recently used tiles if the cache is over its size limit
+        '''
+        path = self._path(key)
+        with open(path + '.part', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.part', path)
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.tif'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def bilinear(grid, minx, maxy, pixel_x, pixel_y, xs, ys, nodata = None):
+    '''
+    Vectorized bilinear interpolation of points on a north up grid.
+
+    :param: grid, 2D array of rows x columns, row 0 at the top (maxy)
+    :param: minx, maxy, the outer top left corner of the grid
+    :param: pixel_x, pixel_y, the pixel sizes, both positive
+    :param: xs, ys, arrays of the point coordinates
+    :param: nodata, optional value in the grid to treat as missing
+
+    :return:
+    An array of the interpolated values, NaN for points off the grid or next to missing values
+    '''
+    grid = np.asarray(grid, dtype = float)
+    if nodata is not None:
+        grid = np.where(grid == nodata, np.nan, grid)
+    nrows, ncols = grid.shape
+    # Position in pixel units, relative to the centre of the top left pixel
+    col = (np.asarray(xs, dtype = float) - minx) / pixel_x - 0.5
+    row = (maxy - np.asarray(ys, dtype = float)) / pixel_y - 0.5
+    c0 = np.clip(np.floor(col).astype(int), 0, max(ncols - 2, 0))
+    r0 = np.clip(np.floor(row).astype(int), 0, max(nrows - 2, 0))
+    c1 = np.minimum(c0 + 1, ncols - 1)
+    r1 = np.minimum(r0 + 1, nrows - 1)
+    fc = np.clip(col - c0, 0, 1)
+    fr = np.clip(row - r0, 0, 1)
+    values = (grid[r0, c0] * (1 - fc) * (1 - fr) + grid[r0, c1] * fc * (1 - fr) +
+              grid[r1, c0] * (1 - fc) * fr + grid[r1, c1] * fc * fr)
+    outside = (col < -0.5) | (col > ncols - 0.5) | (row < -0.5) | (row > nrows - 0.5)
+    values[outside] = np.nan
+    return values
+
+
+class WCSSampler(object):
+    '''
+    Samples a WCS coverage at many points, fetching and caching whole tiles rather than a request per point.
+
+    :param: url, the WCS endpoint
+    :param: coverage, the name of the coverage (layer) to sample
+    :param: resolution, the pixel size of the coverage, in CRS units (eg 1 / 3600 degrees for 1 second SRTM)
+    :param: tile_size, the size of each tile, in CRS units. Rounded to a whole number of pixels
+    :param: crs, the CRS of the points, the tiles and the requests
+    :param: cache_dir, optional directory to cache the tiles in. Without one, tiles are only kept for a single sample() call
+    :param: max_cache_bytes, the size limit of the tile cache
+    :param: workers, the maximum number of tiles fetched at the same time
+    :param: nodata, optional coverage value to treat as missing
+    :param: timeout, the timeout of each request, in seconds
+    :param: image_format, the GetCoverage FORMAT to ask for
+    '''
+    def __init__(self, url, coverage, resolution, tile_size = 0.05, crs = 'EPSG:4326', cache_dir = None,
+                 max_cache_bytes = 1 << 30, workers = 8, nodata = None, timeout = 60, image_format = 'GeoTIFF'):
+        self.url = url
+        self.coverage = coverage
+        self.resolution = resolution
+        self.tile_pixels = max(1, int(round(tile_size / resolution)))
+        self.tile_size = self.tile_pixels * resolution
+        self.crs = crs
+        self.cache = TileCache(cache_dir, max_cache_bytes) if cache_dir is not None else None
+        self.workers = workers
+        self.nodata = nodata
+        self.timeout = timeout
+        self.image_format = image_format
+
+    def tile_bounds(self, tx, ty):
+        '''
+        The request bounds of tile (tx, ty), which is padded by a pixel all round so that points near the edge
+        of the tile still have neighbours to interpolate between.
+
+        :return:
+        A tuple of (minx, miny, maxx, maxy, width, height)
+        '''
+        pad = self.resolution
+        minx = tx * self.tile_size - pad
+        miny = ty * self.tile_size - pad
+        size = self.tile_pixels + 2
+        return minx, miny, minx + size * self.resolution, miny + size * self.resolution, size, size
+
+    def request_url(self, tx, ty):
+        '''
+        The WCS 1.0.0 GetCoverage request for tile (tx, ty)
+        '''
+        minx, miny, maxx, maxy, width, height = self.tile_bounds(tx, ty)
+        params = {'SERVICE': 'WCS', 'VERSION': '1.0.0', 'REQUEST': 'GetCoverage', 'COVERAGE': self.coverage,
+                  'CRS': self.crs, 'BBOX': ','.join(repr(float(v)) for v in (minx, miny, maxx, maxy)),
+                  'WIDTH': width, 'HEIGHT': height, 'FORMAT': self.image_format}
+        separator = '&' if '?' in self.url else '?'
+        return self.url + separator + urlencode(params)
+
+    def fetch_tile(self, tx, ty):
+        '''
+        Get the grid for tile (tx, ty), from the cache if it's there, otherwise from the server (and then cache it)
+
+        :return:
+        The tile as a 2D array
+        '''
+        url = self.request_url(tx, ty)
+        data = self.cache.get(url) if self.cache is not None else None
+        if data is None:
+            with urlopen(url, timeout = self.timeout) as response:
+                content_type = response.headers.get('Content-Type', '')
+                data = response.read()
+            # Service exceptions come back as XML, rather than as an error status
+            if 'xml' in content_type or data[:5] == b'<?xml':
+                raise Exception('WCS request failed for tile {}: {}'.format((tx, ty), data[:500].decode('utf8', 'replace')))
+            if self.cache is not None:
+                self.cache.put(url, data)
+        grid = tifffile.imread(io.BytesIO(data))
+        if grid.ndim == 3:
+            # Only the first band is sampled, whether the bands are stored first (planar) or last (interleaved)
+            grid = grid[0] if grid.shape[0] < grid.shape[-1] else grid[..., 0]
+        return grid
+
+    def sample(self, xs, ys):
+        '''
+        Sample the coverage at many points.
+
+        :param: xs, ys, the point coordinates, in the sampler CRS
+
+        :return:
+        An array of the values at each point, in the same order as the points, NaN where there is no data.
+        A tile that can't be fetched (eg an HTTP error or a service exception) is logged, and leaves just its points as NaN
+        '''
+        xs = np.asarray(xs, dtype = float)
+        ys = np.asarray(ys, dtype = float)
+        result = np.full(len(xs), np.nan)
+        valid = ~(np.isnan(xs) | np.isnan(ys))
+        keys = np.column_stack([np.floor(xs[valid] / self.tile_size), np.floor(ys[valid] / self.tile_size)]).astype(np.int64)
+        if not len(keys):
+            return result
+        tiles, which = np.unique(keys, axis = 0, return_inverse = True)
+        which = which.ravel()
+        points = np.flatnonzero(valid)
+        # Sort the points by tile once, so each tile's points are a contiguous slice
+        order = np.argsort(which, kind = 'stable')
+        starts = np.searchsorted(which[order], np.arange(len(tiles) + 1))
+        with ThreadPoolExecutor(max_workers = self.workers) as pool:
+            futures = {pool.submit(self.fetch_tile, int(tx), int(ty)): i for i, (tx, ty) in enumerate(tiles)}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    grid = future.result()
+                except Exception as e:
+                    logger.warning('Failed to fetch tile {} ({} points left as NaN): {}: {}'.format(
+                        tuple(int(t) for t in tiles[i]), starts[i + 1] - starts[i], type(e).__name__, e))
+                    continue
+                minx, miny, maxx, maxy, width, height = self.tile_bounds(*tiles[i])
+                idx = points[order[starts[i]:starts[i + 1]]]
+                result[idx] = bilinear(grid, minx, maxy, (maxx - minx) / grid.shape[1], (maxy - miny) / grid.shape[0],
+                                       xs[idx], ys[idx], self.nodata)
+        return result
+
+
+def sample_wcs(xs, ys, url, coverage, resolution, **kwargs):
+    '''
+    Convenience wrapper to sample a WCS coverage at many points in one call. See WCSSampler for the options.
+    '''
+    return WCSSampler(url, coverage, resolution, **kwargs).sample(xs, ys)
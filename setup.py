@@ -35,7 +35,8 @@ setup(name='mjb_generic_utils',
             'shapely',
             'scipy',
             'setuptools',
-            'sqlalchemy'
+            'sqlalchemy',
+            'tifffile'
               ],
       packages=['mjb_generic_utils'],
       license='Apache License Version 2.0')
\ No newline at end of file
@@ -0,0 +1,189 @@
+'''
+Round trip tests of gpd_to_spatialite and spatialite_to_gdb on plain (non spatial) tables, which need nothing more
+than sqlite3, so they run without mod_spatialite.
+
+    python -m pytest tests
+'''
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generic_utils import pandas_spatialite
+from generic_utils.db_utils import listTables
+from generic_utils.pandas_spatialite import gpd_to_spatialite, spatialite_to_gdb
+
+
+def frame(index, **columns):
+    return pd.DataFrame(columns, index = pd.Index(index, name = 'OID'))
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix = 'pandas_spatialite_')
+        self.db_path = os.path.join(self.tmp_dir, 'test.sqlite')
+        self.con = sqlite3.connect(self.db_path)
+
+    def tearDown(self):
+        self.con.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors = True)
+
+    def roundTrip(self, df, table = 't'):
+        gpd_to_spatialite(df, self.con, table)
+        return spatialite_to_gdb(self.con, table)
+
+
+class TestDtypeRoundTrip(DatabaseTestCase):
+    def test_numbers_and_text(self):
+        df = frame([1, 2, 3], i = np.array([1, -2, 2 ** 62], dtype = np.int64), f = [0.5, np.nan, 1e300],
+                   s = ['a', None, 'c'])
+        out = self.roundTrip(df)
+        pd.testing.assert_frame_equal(out[['i', 'f']], df[['i', 'f']])
+        self.assertEqual(out['s'].tolist()[::2], ['a', 'c'])
+        self.assertTrue(pd.isna(out['s'].iloc[1]))
+
+    def test_bool(self):
+        df = frame([1, 2], b = [True, False])
+        pd.testing.assert_frame_equal(self.roundTrip(df), df)
+        self.assertEqual(self.con.execute('SELECT typeof(b) FROM t').fetchone()[0], 'integer')
+
+    def test_nullable_types(self):
+        df = frame([1, 2, 3], i = pd.array([1, None, 2 ** 62], dtype = 'Int64'),
+                   b = pd.array([True, None, False], dtype = 'boolean'))
+        pd.testing.assert_frame_equal(self.roundTrip(df), df)
+
+    def test_categorical(self):
+        df = frame([1, 2, 3, 4], c = pd.Categorical(['b', 'a', None, 'b'], categories = ['b', 'a']),
+                   o = pd.Categorical(['lo', 'hi', 'lo', 'mid'], categories = ['lo', 'mid', 'hi'], ordered = True))
+        pd.testing.assert_frame_equal(self.roundTrip(df), df)
+
+    def test_categories_added_by_later_chunks(self):
+        chunks = [frame([1, 2], c = pd.Categorical(['a', 'b'])), frame([3, 4], c = pd.Categorical(['c', 'a']))]
+        gpd_to_spatialite(iter(chunks), self.con, 't')
+        out = spatialite_to_gdb(self.con, 't')
+        self.assertEqual(out['c'].tolist(), ['a', 'b', 'c', 'a'])
+        self.assertEqual(list(out['c'].cat.categories), ['a', 'b', 'c'])
+
+    def test_datetimes(self):
+        df = frame([1, 2, 3], t = pd.to_datetime(['2020-01-01 00:00:00.123456789', None, '1969-12-31 23:59:59.000000000'], format = 'ISO8601'),
+                   tz = pd.to_datetime(['2020-06-01 12:00', '2020-06-02 12:00', None]).tz_localize('Australia/Perth'))
+        out = self.roundTrip(df)
+        pd.testing.assert_frame_equal(out, df)
+        self.assertEqual(str(out['tz'].dt.tz), 'Australia/Perth')
+
+    def test_timedelta(self):
+        df = frame([1, 2, 3], d = pd.to_timedelta(['1 days 00:00:00.000000001', None, '-3s']))
+        pd.testing.assert_frame_equal(self.roundTrip(df), df)
+
+    def test_unit_widened_on_append(self):
+        first = frame([1, 2], t = pd.to_datetime(['2020-01-01 00:00:00', '2020-01-02 00:00:00']).astype('datetime64[s]'))
+        second = frame([3], t = pd.to_datetime(['2020-01-01 00:00:00.5']).astype('datetime64[ms]'))
+        gpd_to_spatialite(first, self.con, 't')
+        gpd_to_spatialite(second, self.con, 't', if_exists = 'append')
+        out = spatialite_to_gdb(self.con, 't')
+        self.assertEqual(str(out['t'].dtype), 'datetime64[ms]')
+        self.assertEqual(out['t'].tolist(), pd.concat([first, second])['t'].tolist())
+
+    def test_unit_widened_within_chunks(self):
+        chunks = [frame([1], d = pd.to_timedelta(['1s']).astype('timedelta64[s]')),
+                  frame([2], d = pd.to_timedelta(['1.5s']).astype('timedelta64[us]'))]
+        gpd_to_spatialite(iter(chunks), self.con, 't')
+        self.assertEqual(spatialite_to_gdb(self.con, 't')['d'].tolist(), [pd.Timedelta('1s'), pd.Timedelta('1.5s')])
+
+    def test_legacy_table_append(self):
+        # A table written before the dtypes were recorded, with its datetimes as text
+        self.con.execute('CREATE TABLE t (OID INTEGER PRIMARY KEY NOT NULL, t TEXT, v INTEGER)')
+        self.con.execute("INSERT INTO t VALUES (1, '2020-01-01 00:00:00', 1)")
+        self.con.commit()
+        df = frame([2], t = pd.to_datetime(['2020-01-02 00:00:00.5']), v = [2])
+        gpd_to_spatialite(df, self.con, 't', if_exists = 'append')
+        self.assertEqual(self.con.execute('SELECT t, v FROM t ORDER BY OID').fetchall(),
+                         [('2020-01-01 00:00:00', 1), ('2020-01-02 00:00:00.500000', 2)])
+        self.assertEqual(self.con.execute("SELECT count(*) FROM sqlite_master WHERE name = 'pandas_dtypes'").fetchone()[0], 0)
+
+    def test_helper_tables_hidden(self):
+        gpd_to_spatialite(frame([1], c = pd.Categorical(['a'])), self.con, 't')
+        gpd_to_spatialite(frame([1], c = pd.Categorical(['b'])), self.con, 't', if_exists = 'sync')
+        self.assertEqual(listTables(self.con, all = False), ['t'])
+        self.assertEqual(set(listTables(self.con)), {'t', 'pandas_dtypes', 't_c_categories', 't_rowhash'})
+
+
+class TestLoadModes(DatabaseTestCase):
+    def test_exists_fails(self):
+        gpd_to_spatialite(frame([1], v = [1]), self.con, 't')
+        with self.assertRaises(Exception):
+            gpd_to_spatialite(frame([2], v = [2]), self.con, 't')
+
+    def test_chunked_append(self):
+        chunks = [frame(range(i * 10, i * 10 + 10), v = np.arange(10) + i) for i in range(5)]
+        gpd_to_spatialite(iter(chunks), self.con, 't', batch_size = 7)
+        gpd_to_spatialite(frame([100], v = [-1]), self.con, 't', if_exists = 'append')
+        pd.testing.assert_frame_equal(spatialite_to_gdb(self.con, 't'), pd.concat(chunks + [frame([100], v = [-1])]))
+
+    def test_sync(self):
+        df = frame([1, 2, 3], v = [1, 2, 3], s = ['a', 'b', 'c'])
+        gpd_to_spatialite(df, self.con, 't')
+        new = frame([2, 3, 4], v = [2, 30, 4], s = ['b', 'c', 'd'])
+        gpd_to_spatialite(new, self.con, 't', if_exists = 'sync')
+        pd.testing.assert_frame_equal(spatialite_to_gdb(self.con, 't'), new)
+        # Unchanged rows aren't rewritten on the next sync
+        changes = self.con.total_changes
+        gpd_to_spatialite(new, self.con, 't', if_exists = 'sync')
+        self.assertEqual(spatialite_to_gdb(self.con, 't')['v'].tolist(), [2, 30, 4])
+        self.assertEqual(self.con.total_changes, changes)
+
+    def test_interrupted_load_rolled_back(self):
+        gpd_to_spatialite(frame([1], v = [1]), self.con, 't')
+        insert_batches = pandas_spatialite._insert_batches
+
+        def interrupt(cur, sql, rows, batch_size):
+            insert_batches(cur, sql, list(rows)[:10], batch_size)
+            raise KeyboardInterrupt
+
+        with mock.patch.object(pandas_spatialite, '_insert_batches', interrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                gpd_to_spatialite(frame(range(2, 102), v = range(100)), self.con, 't', if_exists = 'append', batch_size = 10)
+        other = sqlite3.connect(self.db_path)
+        self.assertEqual(other.execute('SELECT count(*) FROM t').fetchone()[0], 1)
+        other.close()
+
+    def test_checkpoint_resume(self):
+        chunks = [frame(range(i * 10, i * 10 + 10), v = np.arange(10)) for i in range(5)]
+
+        def interrupted():
+            for i, chunk in enumerate(chunks):
+                if i == 3:
+                    raise KeyboardInterrupt
+                yield chunk
+
+        with self.assertRaises(KeyboardInterrupt):
+            gpd_to_spatialite(interrupted(), self.con, 't', checkpoint = 'source.csv')
+        self.assertEqual(self.con.execute('SELECT count(*) FROM t').fetchone()[0], 30)
+        # A load of another table under the same checkpoint name keeps its own progress
+        gpd_to_spatialite(iter(chunks[:1]), self.con, 'u', checkpoint = 'source.csv')
+        gpd_to_spatialite(iter(chunks), self.con, 't', checkpoint = 'source.csv')
+        pd.testing.assert_frame_equal(spatialite_to_gdb(self.con, 't'), pd.concat(chunks))
+        self.assertEqual(self.con.execute('SELECT count(*) FROM load_checkpoints').fetchone()[0], 0)
+
+
+class TestRead(DatabaseTestCase):
+    def test_columns_where_and_chunks(self):
+        df = frame(range(10), v = np.arange(10), w = np.arange(10) * 2.0)
+        gpd_to_spatialite(df, self.con, 't')
+        out = spatialite_to_gdb(self.con, 't', columns = ['w'], where = 'v >= ?', params = (5,))
+        pd.testing.assert_frame_equal(out, df.loc[5:, ['w']])
+        chunks = list(spatialite_to_gdb(self.con, 't', chunksize = 4))
+        self.assertEqual([len(chunk) for chunk in chunks], [4, 4, 2])
+        pd.testing.assert_frame_equal(pd.concat(chunks), df)
+
+
+if __name__ == '__main__':
+    unittest.main()
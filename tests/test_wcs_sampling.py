@@ -0,0 +1,163 @@
+'''
+Tests of WCSSampler against a local stand-in WCS server.
+
+The stand-in answers WCS 1.0.0 GetCoverage requests with GeoTIFF tiles of the plane z = 100 + 10x + 20y (which
+bilinear interpolation reproduces exactly), and fails requests for tiles with minx past FAIL_X, some with a service
+exception and some with an HTTP error.
+
+    python -m pytest tests
+'''
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import tifffile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generic_utils.wcs_sampling import TileCache, WCSSampler
+
+FAIL_X = 0.5
+
+
+def plane(x, y):
+    return 100 + 10 * x + 20 * y
+
+
+class StandInWCS(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        query = {key.upper(): values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        self.requests.append(query)
+        minx, miny, maxx, maxy = (float(v) for v in query['BBOX'].split(','))
+        width, height = int(query['WIDTH']), int(query['HEIGHT'])
+        if minx > FAIL_X:
+            if miny > 0:
+                self.send_error(500, 'Stand-in server error')
+            else:
+                self._send('application/vnd.ogc.se_xml',
+                           b'<?xml version="1.0"?><ServiceExceptionReport><ServiceException>'
+                           b'Stand-in service exception</ServiceException></ServiceExceptionReport>')
+            return
+        # Pixel centres, row 0 at the top
+        x = minx + (np.arange(width) + 0.5) * (maxx - minx) / width
+        y = maxy - (np.arange(height) + 0.5) * (maxy - miny) / height
+        out = io.BytesIO()
+        tifffile.imwrite(out, plane(x[np.newaxis, :], y[:, np.newaxis]).astype(np.float32))
+        self._send('image/tiff', out.getvalue())
+
+    def _send(self, content_type, data):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestWCSSampler(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInWCS)
+        cls.thread = threading.Thread(target = cls.server.serve_forever, daemon = True)
+        cls.thread.start()
+        cls.url = 'http://127.0.0.1:{}/wcs'.format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StandInWCS.requests = []
+        self.cache_dir = tempfile.mkdtemp(prefix = 'wcs_cache_')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors = True)
+
+    def sampler(self, **kwargs):
+        return WCSSampler(self.url, 'dem', resolution = 0.01, tile_size = 0.1, cache_dir = self.cache_dir, **kwargs)
+
+    def test_bilinear_values(self):
+        rng = np.random.default_rng(0)
+        xs = rng.uniform(-0.3, 0.3, 500)
+        ys = rng.uniform(-0.3, 0.3, 500)
+        values = self.sampler().sample(xs, ys)
+        np.testing.assert_allclose(values, plane(xs, ys), atol = 1e-3)
+        # One request per tile, not per point
+        self.assertEqual(len(StandInWCS.requests), len({(int(np.floor(x / 0.1)), int(np.floor(y / 0.1))) for x, y in zip(xs, ys)}))
+
+    def test_cache_reused(self):
+        xs = np.array([0.01, 0.05, 0.15])
+        ys = np.array([0.01, 0.05, 0.01])
+        first = self.sampler().sample(xs, ys)
+        self.assertEqual(len(StandInWCS.requests), 2)
+        second = self.sampler().sample(xs, ys)
+        self.assertEqual(len(StandInWCS.requests), 2)
+        np.testing.assert_array_equal(first, second)
+
+    def test_missing_points(self):
+        values = self.sampler().sample([np.nan, 0.05], [0.05, np.nan])
+        self.assertTrue(np.isnan(values).all())
+        self.assertEqual(StandInWCS.requests, [])
+
+    def test_failed_tiles_left_as_nan(self):
+        xs = np.array([0.05, 0.75, 0.25, 0.75])
+        ys = np.array([0.05, -0.25, -0.05, 0.25])
+        with self.assertLogs('generic_utils.wcs_sampling', 'WARNING') as logs:
+            values = self.sampler().sample(xs, ys)
+        np.testing.assert_allclose(values[[0, 2]], plane(xs[[0, 2]], ys[[0, 2]]), atol = 1e-3)
+        self.assertTrue(np.isnan(values[[1, 3]]).all())
+        self.assertEqual(len(logs.output), 2)
+        # Failures aren't cached, so they are retried next time
+        self.sampler().sample(xs[[1]], ys[[1]])
+        self.assertEqual(len(StandInWCS.requests), 5)
+
+
+class TestTileCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix = 'wcs_cache_')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors = True)
+
+    def test_evicted_after_read(self):
+        cache = TileCache(self.cache_dir)
+        cache.put('tile', b'data')
+        utime = os.utime
+
+        def evict_then_touch(path, *args, **kwargs):
+            # Another sampler evicts the tile between the read and the touch
+            os.remove(path)
+            return utime(path, *args, **kwargs)
+
+        with mock.patch('generic_utils.wcs_sampling.os.utime', evict_then_touch):
+            self.assertEqual(cache.get('tile'), b'data')
+        self.assertIsNone(cache.get('tile'))
+
+    def test_evicts_least_recently_used(self):
+        cache = TileCache(self.cache_dir, max_bytes = 10)
+        cache.put('a', b'12345')
+        cache.put('b', b'12345')
+        os.utime(cache._path('a'), ns = (1, 1))
+        cache.get('a')
+        os.utime(cache._path('b'), ns = (2, 2))
+        cache.put('c', b'12345')
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+
+if __name__ == '__main__':
+    unittest.main()